@@ -31,16 +31,23 @@ operations; however:
 """
 
 import argparse
+import array
+import bisect
 import collections
 import fnmatch
 import gettext
+import hashlib
+import heapq
 import io
+import marshal
 import os
 import platform
 import re
 import shutil
+import struct
 import subprocess
 import sys
+import tempfile
 import time
 import textwrap
 
@@ -53,10 +60,11 @@ __all__ = ["Blob", "Reset", "FileChange", "Commit", "Tag", "Progress",
 
 # The globals to make visible to callbacks. They will see all our imports for
 # free, as well as our public API.
-public_globals = ["__builtins__", "argparse", "collections", "fnmatch",
-                  "gettext", "io", "os", "platform", "re", "shutil",
-                  "subprocess", "sys", "time", "textwrap", "tzinfo",
-                  "timedelta", "datetime"] + __all__
+public_globals = ["__builtins__", "argparse", "array", "bisect",
+                  "collections", "fnmatch", "gettext", "hashlib", "heapq",
+                  "io", "marshal", "os", "platform", "re", "shutil", "struct",
+                  "subprocess", "sys", "tempfile", "time", "textwrap",
+                  "tzinfo", "timedelta", "datetime"] + __all__
 
 deleted_hash = b'0'*40
 write_marks = True
@@ -217,44 +225,218 @@ class AncestryGraph(object):
   A note about identifiers in AncestryGraph objects, of which there are three:
     * A given AncestryGraph is based on either commit.old_id or commit.id, but
       not both.  These are the keys for self.value.
-    * Using full hashes (occasionally) for children in self.graph felt
-      wasteful, so we use our own internal integer within self.graph.
+    * Using full hashes (occasionally) for children in the graph felt
+      wasteful, so we use our own internal integer within the graph.
       self.value maps from commit {old_}id to our internal integer id.
     * When working with commit.old_id, it is also sometimes useful to be able
       to map these to the original hash, i.e. commit.original_id.  So, we
-      also have self.git_hash for mapping from commit.old_id to git's commit
-      hash.
+      also record git's commit hash for each commit, when known; see
+      map_to_hash() and map_from_hash().
+
+  Histories can have millions of commits, so everything other than
+  self.value is stored in arrays indexed by our internal integer id rather
+  than in per-commit python objects.  The self.graph and self.git_hash
+  dicts of earlier versions are still available as read-only properties,
+  but are built afresh on every access.
+
+  Since parents must be added before their children, internal ids are a
+  topological ordering of the graph, and depths act as generation numbers;
+  is_ancestor() uses both to answer many queries without walking the graph.
+  If reachability_index is True, an additional index of Bloom-filtered
+  ancestor sets is maintained; see _add().
   """
 
-  def __init__(self):
+  def __init__(self, reachability_index = False):
     # The next internal identifier we will use; increments with every commit
     # added to the AncestryGraph
     self.cur_value = 0
 
     # A mapping from the external identifers given to us to the simple integers
-    # we use in self.graph
+    # we use in the graph
     self.value = {}
 
-    # A tuple of (depth, list-of-ancestors).  Values and keys in this graph are
-    # all integers from the (values of the) self.value dict.  The depth of a
-    # commit is one more than the max depth of any of its ancestors.
-    self.graph = {}
-
-    # A mapping from external identifier (i.e. from the keys of self.value) to
-    # the hash of the given commit.  Only populated for graphs based on
-    # commit.old_id, since we won't know until later what the git_hash for
-    # graphs based on commit.id (since we have to wait for fast-import to
-    # create the commit and notify us of its hash; see _pending_renames).
-    # elsewhere
-    self.git_hash = {}
-
-    # Reverse maps; only populated if needed.  Caller responsible to check
-    # and ensure they are populated
-    self._reverse_value = {}
+    # The depth of each commit, indexed by internal id (index 0 is unused).
+    # The depth of a commit is one more than the max depth of any of its
+    # ancestors.
+    self._depth = array.array('I', [0])
+
+    # The parents of each commit, in compressed sparse row form: the
+    # internal ids of the parents of commit i are
+    #   self._parents[self._parent_start[i]:self._parent_start[i+1]]
+    self._parent_start = array.array('I', [0, 0])
+    self._parents = array.array('I')
+
+    # The binary hash of each commit, 20 bytes per internal id, or all zeros
+    # if not known.  Only populated for graphs based on commit.old_id, since
+    # we won't know until later what the hash is for graphs based on
+    # commit.id (since we have to wait for fast-import to create the commit
+    # and notify us of its hash; see _pending_renames).  Hashes which are
+    # not 40 hex characters are instead stored in self._other_hashes.
+    self._hashes = bytearray(20)
+    self._other_hashes = {}
+
+    # Reverse maps; only populated if needed, see
+    # _ensure_reverse_maps_populated()
+    self._reverse_value = []
     self._hash_to_id = {}
 
-    # Cached results from previous calls to is_ancestor().
+    # Cached results from previous calls to is_ancestor(), keyed by
+    # (ancestor_internal_id << 32 | descendant_internal_id).  Kept in two
+    # generations so that memory stays bounded; see _remember_ancestor().
     self._cached_is_ancestor = {}
+    self._old_cached_is_ancestor = {}
+    self.cache_hits = 0
+    self.cache_misses = 0
+
+    # Optional reachability index.  Commits are grouped into epochs of
+    # _epoch_depth consecutive depths.  For each commit we keep a 64-bit
+    # Bloom filter of its ancestors (including itself) in its own epoch, and
+    # another of its ancestors in the previous epoch.  Only looking at a
+    # window of depths keeps the filters from saturating on long histories.
+    self._bloom = None
+    self._prev_bloom = None
+    if reachability_index:
+      self._bloom = array.array('Q', [0])
+      self._prev_bloom = array.array('Q', [0])
+
+  _no_hash = bytes(20)
+
+  def get_state(self):
+    '''
+    Returns the graph as a dict of plain bytes, ints and dicts, e.g. for
+    saving with marshal; see from_state().  Cached answers and reverse maps
+    are recomputed as needed, so they are not included.
+    '''
+    return {'cur_value': self.cur_value,
+            'value': self.value,
+            'depth': self._depth.tobytes(),
+            'parent_start': self._parent_start.tobytes(),
+            'parents': self._parents.tobytes(),
+            'hashes': bytes(self._hashes),
+            'other_hashes': self._other_hashes,
+            'bloom': None if self._bloom is None else self._bloom.tobytes(),
+            'prev_bloom': (None if self._prev_bloom is None
+                           else self._prev_bloom.tobytes())}
+
+  @staticmethod
+  def from_state(state):
+    '''
+    Returns the AncestryGraph whose get_state() returned state.  Raises
+    ValueError if state is not a consistent graph.
+    '''
+    if type(state) is not dict or type(state['cur_value']) is not int or \
+       type(state['value']) is not dict or \
+       type(state['other_hashes']) is not dict:
+      raise ValueError("not an AncestryGraph state")
+    graph = AncestryGraph(reachability_index = state['bloom'] is not None)
+    graph.cur_value = num = state['cur_value']
+    graph.value = state['value']
+    graph._other_hashes = state['other_hashes']
+    graph._depth = array.array('I', state['depth'])
+    graph._parent_start = array.array('I', state['parent_start'])
+    graph._parents = array.array('I', state['parents'])
+    graph._hashes = bytearray(state['hashes'])
+    if graph._bloom is not None:
+      graph._bloom = array.array('Q', state['bloom'])
+      graph._prev_bloom = array.array('Q', state['prev_bloom'])
+    if len(graph._depth) != num + 1 or \
+       len(graph._parent_start) != num + 2 or \
+       len(graph._hashes) != 20 * (num + 1) or \
+       graph._parent_start[-1] != len(graph._parents) or \
+       len(graph.value) > num or \
+       any(type(v) is not int or not 0 < v <= num
+           for v in graph.value.values()) or \
+       any(p > num for p in graph._parents) or \
+       (graph._bloom is not None and
+        (len(graph._bloom) != num + 1 or len(graph._prev_bloom) != num + 1)):
+      raise ValueError("inconsistent AncestryGraph state")
+    return graph
+
+  # Maximum number of is_ancestor() results we remember at any one time
+  _max_cached_is_ancestor = 1 << 18
+
+  # Number of depths covered by each epoch of the reachability index
+  _epoch_depth = 16
+
+  @staticmethod
+  def _bloom_bit(internal_id):
+    return 1 << ((internal_id * 2654435761) >> 16 & 63)
+
+  def _add(self, graph_parents, githash):
+    self.cur_value += 1
+    depth = 1
+    if graph_parents:
+      depth += max(self._depth[p] for p in graph_parents)
+    self._depth.append(depth)
+    self._parents.extend(graph_parents)
+    self._parent_start.append(len(self._parents))
+    if self._bloom is not None:
+      # Ancestors of a parent are all shallower than it, so a parent in an
+      # earlier epoch than the previous one contributes nothing.
+      epoch = depth // self._epoch_depth
+      bloom, prev_bloom = self._bloom_bit(self.cur_value), 0
+      for p in graph_parents:
+        parent_epoch = self._depth[p] // self._epoch_depth
+        if parent_epoch == epoch:
+          bloom |= self._bloom[p]
+          prev_bloom |= self._prev_bloom[p]
+        elif parent_epoch == epoch - 1:
+          prev_bloom |= self._bloom[p]
+      self._bloom.append(bloom)
+      self._prev_bloom.append(prev_bloom)
+    binary = githash and self._binary_hash(githash)
+    self._hashes += binary or self._no_hash
+    if githash and not binary:
+      self._other_hashes[self.cur_value] = githash
+    return self.cur_value
+
+  def _binary_hash(self, githash):
+    '''
+    Return githash as 20 bytes, or None if githash is not a (nonzero) hash
+    written as 40 lowercase hex characters.
+    '''
+    if len(githash) != 40 or not githash.islower():
+      return None
+    try:
+      binary = bytes.fromhex(githash.decode())
+    except ValueError:
+      return None
+    if len(binary) != 20 or binary == self._no_hash:
+      return None
+    return binary
+
+  def _set_hash(self, internal_id, githash):
+    binary = self._binary_hash(githash)
+    if binary:
+      self._hashes[20*internal_id : 20*internal_id+20] = binary
+    else:
+      self._other_hashes[internal_id] = githash
+
+  def _get_hash(self, internal_id):
+    binary = self._hashes[20*internal_id : 20*internal_id+20]
+    if binary == self._no_hash:
+      return self._other_hashes.get(internal_id)
+    return binary.hex().encode()
+
+  @property
+  def graph(self):
+    '''
+    A dict mapping each internal id to a tuple of (depth, list of the
+    internal ids of its parents).
+    '''
+    start = self._parent_start
+    return {i: (self._depth[i], list(self._parents[start[i]:start[i+1]]))
+            for i in range(1, self.cur_value + 1)}
+
+  @property
+  def git_hash(self):
+    '''
+    A dict mapping external identifiers (i.e. the keys of self.value) to
+    the hash of the given commit, for those commits whose hash is known.
+    '''
+    hashes = ((commit_id, self._get_hash(internal_id))
+              for commit_id, internal_id in self.value.items())
+    return {commit_id: githash for commit_id, githash in hashes if githash}
 
   def record_external_commits(self, external_commits):
     """
@@ -263,10 +445,7 @@ class AncestryGraph(object):
     """
     for c in external_commits:
       if c not in self.value:
-        self.cur_value += 1
-        self.value[c] = self.cur_value
-        self.graph[self.cur_value] = (1, [])
-        self.git_hash[c] = c
+        self.value[c] = self._add((), c)
 
   def add_commit_and_parents(self, commit, parents, githash = None):
     """
@@ -279,18 +458,7 @@ class AncestryGraph(object):
     assert all(p in self.value for p in parents)
     assert commit not in self.value
 
-    # Get values for commit and parents
-    self.cur_value += 1
-    self.value[commit] = self.cur_value
-    if githash:
-      self.git_hash[commit] = githash
-    graph_parents = [self.value[x] for x in parents]
-
-    # Determine depth for commit, then insert the info into the graph
-    depth = 1
-    if parents:
-      depth += max(self.graph[p][0] for p in graph_parents)
-    self.graph[self.cur_value] = (depth, graph_parents)
+    self.value[commit] = self._add([self.value[x] for x in parents], githash)
 
   def record_hash(self, commit_id, githash):
     '''
@@ -298,14 +466,30 @@ class AncestryGraph(object):
     was called, add it now.
     '''
     assert commit_id in self.value
-    assert commit_id not in self.git_hash
-    self.git_hash[commit_id] = githash
+    internal_id = self.value[commit_id]
+    assert self._get_hash(internal_id) is None
+    self._set_hash(internal_id, githash)
 
   def _ensure_reverse_maps_populated(self):
-    if not self._hash_to_id:
-      assert not self._reverse_value
-      self._hash_to_id = {v: k for k, v in self.git_hash.items()}
-      self._reverse_value = {v: k for k, v in self.value.items()}
+    if len(self._reverse_value) != self.cur_value + 1:
+      self._reverse_value = [None] * (self.cur_value + 1)
+      self._hash_to_id = {}
+      for commit_id, internal_id in self.value.items():
+        self._reverse_value[internal_id] = commit_id
+      hashes = self._hashes
+      for internal_id in range(1, self.cur_value + 1):
+        binary = bytes(hashes[20*internal_id : 20*internal_id+20])
+        if binary != self._no_hash:
+          self._hash_to_id[binary] = internal_id
+      for internal_id, githash in self._other_hashes.items():
+        self._hash_to_id[githash] = internal_id
+
+  def _hash_to_internal_id(self, githash):
+    self._ensure_reverse_maps_populated()
+    binary = self._binary_hash(githash)
+    if binary in self._hash_to_id:
+      return self._hash_to_id[binary]
+    return self._hash_to_id[githash]
 
   def get_parent_hashes(self, commit_hash):
     '''
@@ -313,56 +497,161 @@ class AncestryGraph(object):
     '''
     #
     # We have to map:
-    #    commit hash -> fast export stream id -> graph id
+    #    commit hash -> graph id
     # then lookup
     #    parent graph ids for given graph id
     # then we need to map
-    #    parent graph ids -> parent fast export ids -> parent commit hashes
+    #    parent graph ids -> parent commit hashes
     #
-    self._ensure_reverse_maps_populated()
-    commit_fast_export_id = self._hash_to_id[commit_hash]
-    commit_graph_id = self.value[commit_fast_export_id]
-    parent_graph_ids = self.graph[commit_graph_id][1]
-    parent_fast_export_ids = [self._reverse_value[x] for x in parent_graph_ids]
-    parent_hashes = [self.git_hash[x] for x in parent_fast_export_ids]
-    return parent_hashes
+    commit_graph_id = self._hash_to_internal_id(commit_hash)
+    start, end = self._parent_start[commit_graph_id:commit_graph_id+2]
+    return [self._get_hash(x) for x in self._parents[start:end]]
 
   def map_to_hash(self, commit_id):
     '''
     Given a commit (by fast export stream id), return its hash
     '''
-    return self.git_hash.get(commit_id, None)
+    internal_id = self.value.get(commit_id)
+    if internal_id is None:
+      return None
+    return self._get_hash(internal_id)
+
+  def map_from_hash(self, commit_hash):
+    '''
+    Given a commit hash, return its fast export stream id
+    '''
+    internal_id = self._hash_to_internal_id(commit_hash)
+    return self._reverse_value[internal_id]
+
+  def _remember_ancestor(self, key, answer):
+    # Once the current generation of cached answers fills up, it becomes the
+    # old generation and the previous old generation is dropped.  Answers
+    # still being used get copied forward into the current generation when
+    # looked up, so this approximates an LRU without per-lookup bookkeeping.
+    if len(self._cached_is_ancestor) >= self._max_cached_is_ancestor // 2:
+      self._old_cached_is_ancestor = self._cached_is_ancestor
+      self._cached_is_ancestor = {}
+    self._cached_is_ancestor[key] = answer
 
   def is_ancestor(self, possible_ancestor, check):
     """
     Return whether possible_ancestor is an ancestor of check
     """
     a, b = self.value[possible_ancestor], self.value[check]
-    original_pair = (a,b)
-    a_depth = self.graph[a][0]
+    depth, parent_start, parents = \
+      self._depth, self._parent_start, self._parents
+
+    # An ancestor always has both a smaller internal id and a smaller depth
+    # than its descendants, so many queries need no walk at all.
+    if a == b:
+      return True
+    a_depth = depth[a]
+    if a > b or depth[b] <= a_depth:
+      return False
+    start, end = parent_start[b], parent_start[b+1]
+    if a in parents[start:end]:
+      return True
+
+    # For commits with depth below bloom_limit, the reachability index
+    # covers the epoch of a; a missing bit in their Bloom filter means a is
+    # not among their ancestors.
+    bloom, prev_bloom = self._bloom, self._prev_bloom
+    bloom_limit = 0
+    if bloom is not None:
+      epoch_start = a_depth - a_depth % self._epoch_depth
+      prev_limit = epoch_start + self._epoch_depth
+      bloom_limit = prev_limit + self._epoch_depth
+      a_bit = self._bloom_bit(a)
+      b_depth = depth[b]
+      if b_depth < bloom_limit and not a_bit & \
+         (bloom[b] if b_depth < prev_limit else prev_bloom[b]):
+        return False
+
+    a_key = a << 32
+    cache, old_cache = self._cached_is_ancestor, self._old_cached_is_ancestor
+    answer = cache.get(a_key | b)
+    if answer is None:
+      answer = old_cache.get(a_key | b)
+      if answer is not None:
+        self._remember_ancestor(a_key | b, answer)
+    if answer is not None:
+      self.cache_hits += 1
+      return answer
+    self.cache_misses += 1
+
     ancestors = [b]
     visited = set()
     while ancestors:
       ancestor = ancestors.pop()
-      prev_pair = (a, ancestor)
-      if prev_pair in self._cached_is_ancestor:
-        if not self._cached_is_ancestor[prev_pair]:
+      answer = cache.get(a_key | ancestor)
+      if answer is None:
+        answer = old_cache.get(a_key | ancestor)
+      if answer is not None:
+        if not answer:
           continue
-        self._cached_is_ancestor[original_pair] = True
+        self._remember_ancestor(a_key | b, True)
         return True
       if ancestor in visited:
         continue
       visited.add(ancestor)
-      depth, more_ancestors = self.graph[ancestor]
       if ancestor == a:
-        self._cached_is_ancestor[original_pair] = True
+        self._remember_ancestor(a_key | b, True)
         return True
-      elif depth <= a_depth:
+      ancestor_depth = depth[ancestor]
+      if ancestor_depth <= a_depth or ancestor < a:
+        continue
+      elif ancestor_depth < bloom_limit and not a_bit & \
+           (bloom[ancestor] if ancestor_depth < prev_limit
+            else prev_bloom[ancestor]):
         continue
-      ancestors.extend(more_ancestors)
-    self._cached_is_ancestor[original_pair] = False
+      start, end = parent_start[ancestor], parent_start[ancestor+1]
+      if end == start + 1:
+        ancestors.append(parents[start])
+      else:
+        ancestors.extend(parents[start:end])
+    self._remember_ancestor(a_key | b, False)
     return False
 
+class HashPrefixIndex(object):
+  """
+  An index of (hex) commit hashes supporting lookup by abbreviated hash.
+
+  Hashes are kept in sorted lists, bucketed by their first three characters
+  so that adding a hash never has to shift more than a small list.  Lookups
+  of a prefix are a binary search within its bucket.  The index only keeps
+  references to the hashes it is given, so it costs little more than a
+  pointer per hash.
+  """
+
+  # Abbreviated hashes shorter than this are never looked up
+  min_length = 7
+
+  def __init__(self):
+    self._buckets = {}
+
+  def add(self, githash):
+    bucket = self._buckets.setdefault(githash[0:3], [])
+    index = bisect.bisect_left(bucket, githash)
+    if index == len(bucket) or bucket[index] != githash:
+      bucket.insert(index, githash)
+
+  def lookup(self, prefix, limit=2):
+    """
+    Return a list of the hashes starting with prefix, stopping once limit
+    of them have been found.
+    """
+    if len(prefix) < self.min_length:
+      return []
+    bucket = self._buckets.get(prefix[0:3], ())
+    index = bisect.bisect_left(bucket, prefix)
+    matches = []
+    while index < len(bucket) and bucket[index].startswith(prefix):
+      matches.append(bucket[index])
+      if len(matches) == limit:
+        break
+      index += 1
+    return matches
+
 class MailmapInfo(object):
   def __init__(self, filename):
     self.changes = {}
@@ -537,6 +826,12 @@ class _GitElement(object):
   """
   The base class for all git elements that we create.
   """
+  # A single export can create tens of millions of these elements (mostly
+  # FileChanges), so keep their own attributes in slots.  Subclasses must
+  # list any attributes they add in their own __slots__.  The __dict__
+  # slot remains so callbacks can still set attributes of their own on
+  # elements; the dict is only created if they do.
+  __slots__ = ('type', 'dumped', '__dict__')
 
   def __init__(self):
     # A string that describes what type of Git element this is
@@ -580,6 +875,7 @@ class _GitElementWithId(_GitElement):
   """
   The base class for Git elements that have IDs (commits and blobs)
   """
+  __slots__ = ('id', 'old_id')
 
   def __init__(self):
     _GitElement.__init__(self)
@@ -605,6 +901,7 @@ class Blob(_GitElementWithId):
   This class defines our representation of git blob elements (i.e. our
   way of representing file contents).
   """
+  __slots__ = ('original_id', 'data')
 
   def __init__(self, data, original_id = None):
     _GitElementWithId.__init__(self)
@@ -627,10 +924,15 @@ class Blob(_GitElementWithId):
     BLOB_HASH_TO_NEW_ID[self.original_id] = self.id
     BLOB_NEW_ID_TO_HASH[self.id] = self.original_id
 
-    file_.write(b'blob\n')
-    file_.write(b'mark :%d\n' % self.id)
-    file_.write(b'data %d\n%s' % (len(self.data), self.data))
-    file_.write(b'\n')
+    if len(self.data) < 65536:
+      file_.write(b'blob\nmark :%d\ndata %d\n%s\n' %
+                  (self.id, len(self.data), self.data))
+    else:
+      # Avoid copying large blobs into a formatted string; hand the data
+      # over as is
+      file_.writelines([b'blob\nmark :%d\ndata %d\n' % (self.id, len(self.data)),
+                        self.data,
+                        b'\n'])
 
 
 class Reset(_GitElement):
@@ -639,6 +941,7 @@ class Reset(_GitElement):
   event is the creation (or recreation) of a named branch, optionally
   starting from a specific revision).
   """
+  __slots__ = ('ref', 'from_ref')
 
   def __init__(self, ref, from_ref = None):
     _GitElement.__init__(self)
@@ -658,19 +961,19 @@ class Reset(_GitElement):
     """
     self.dumped = 1
 
-    file_.write(b'reset %s\n' % self.ref)
-    if self.from_ref:
-      if isinstance(self.from_ref, int):
-        file_.write(b'from :%d\n' % self.from_ref)
-      else:
-        file_.write(b'from %s\n' % self.from_ref)
-      file_.write(b'\n')
+    if not self.from_ref:
+      file_.write(b'reset %s\n' % self.ref)
+    elif isinstance(self.from_ref, int):
+      file_.write(b'reset %s\nfrom :%d\n\n' % (self.ref, self.from_ref))
+    else:
+      file_.write(b'reset %s\nfrom %s\n\n' % (self.ref, self.from_ref))
 
 class FileChange(_GitElement):
   """
   This class defines our representation of file change elements. File change
   elements are components within a Commit element.
   """
+  __slots__ = ('filename', 'mode', 'blob_id')
 
   def __init__(self, type_, filename = None, id_ = None, mode = None):
     _GitElement.__init__(self)
@@ -712,19 +1015,28 @@ class FileChange(_GitElement):
     """
     Write this file-change element to a file
     """
+    line = self._dump_line()
+    if line:
+      file_.write(line)
+
+  def _dump_line(self):
+    """
+    Return the line to write for this file-change element (marking it as
+    dumped), or None if it should not be written
+    """
     skipped_blob = (self.type == b'M' and self.blob_id is None)
-    if skipped_blob: return
+    if skipped_blob: return None
     self.dumped = 1
 
     quoted_filename = PathQuoting.enquote(self.filename)
     if self.type == b'M' and isinstance(self.blob_id, int):
-      file_.write(b'M %s :%d %s\n' % (self.mode, self.blob_id, quoted_filename))
+      return b'M %s :%d %s\n' % (self.mode, self.blob_id, quoted_filename)
     elif self.type == b'M':
-      file_.write(b'M %s %s %s\n' % (self.mode, self.blob_id, quoted_filename))
+      return b'M %s %s %s\n' % (self.mode, self.blob_id, quoted_filename)
     elif self.type == b'D':
-      file_.write(b'D %s\n' % quoted_filename)
+      return b'D %s\n' % quoted_filename
     elif self.type == b'DELETEALL':
-      file_.write(b'deleteall\n')
+      return b'deleteall\n'
     else:
       raise SystemExit(_("Unhandled filechange type: %s") % self.type) # pragma: no cover
 
@@ -733,6 +1045,10 @@ class Commit(_GitElementWithId):
   This class defines our representation of commit elements. Commit elements
   contain all the information associated with a commit.
   """
+  __slots__ = ('branch', 'original_id',
+               'author_name', 'author_email', 'author_date',
+               'committer_name', 'committer_email', 'committer_date',
+               'encoding', 'message', 'file_changes', 'parents')
 
   def __init__(self, branch,
                author_name,    author_email,    author_date,
@@ -795,34 +1111,43 @@ class Commit(_GitElementWithId):
     if self.message.endswith(b'\n') or not (self.parents or self.file_changes):
       extra_newline = b''
 
+    # Gather up all the pieces and write them out in one go
+    parts = []
     if not self.parents:
-      file_.write(b'reset %s\n' % self.branch)
-    file_.write((b'commit %s\n'
-                 b'mark :%d\n'
-                 b'author %s <%s> %s\n'
-                 b'committer %s <%s> %s\n'
-                ) % (
-                  self.branch, self.id,
-                  self.author_name, self.author_email, self.author_date,
-                  self.committer_name, self.committer_email, self.committer_date
-               ))
+      parts.append(b'reset %s\n' % self.branch)
+    parts.append((b'commit %s\n'
+                  b'mark :%d\n'
+                  b'author %s <%s> %s\n'
+                  b'committer %s <%s> %s\n'
+                 ) % (
+                   self.branch, self.id,
+                   self.author_name, self.author_email, self.author_date,
+                   self.committer_name, self.committer_email, self.committer_date
+                ))
     if self.encoding:
-      file_.write(b'encoding %s\n' % self.encoding)
-    file_.write(b'data %d\n%s%s' %
-                (len(self.message), self.message, extra_newline))
+      parts.append(b'encoding %s\n' % self.encoding)
+    parts.append(b'data %d\n' % len(self.message))
+    parts.append(self.message)
+    parts.append(extra_newline)
     for i, parent in enumerate(self.parents):
-      file_.write(b'from ' if i==0 else b'merge ')
       if isinstance(parent, int):
-        file_.write(b':%d\n' % parent)
+        parts.append((b'from :%d\n' if i==0 else b'merge :%d\n') % parent)
       else:
-        file_.write(b'%s\n' % parent)
+        parts.append((b'from %s\n' if i==0 else b'merge %s\n') % parent)
     for change in self.file_changes:
-      change.dump(file_)
+      line = change._dump_line()
+      if line:
+        parts.append(line)
+        # Don't hold all of a huge commit's file changes in memory at once
+        if len(parts) >= 1024:
+          file_.write(b''.join(parts))
+          parts = []
     if not self.parents and not self.file_changes:
       # Workaround a bug in pre-git-2.22 versions of fast-import with
       # the get-mark directive.
-      file_.write(b'\n')
-    file_.write(b'\n')
+      parts.append(b'\n')
+    parts.append(b'\n')
+    file_.write(b''.join(parts))
 
   def first_parent(self):
     """
@@ -840,6 +1165,8 @@ class Tag(_GitElementWithId):
   """
   This class defines our representation of annotated tag elements.
   """
+  __slots__ = ('ref', 'from_ref', 'original_id',
+               'tagger_name', 'tagger_email', 'tagger_date', 'message')
 
   def __init__(self, ref, from_ref,
                tagger_name, tagger_email, tagger_date, tag_msg,
@@ -878,17 +1205,19 @@ class Tag(_GitElementWithId):
 
     self.dumped = 1
 
-    file_.write(b'tag %s\n' % self.ref)
+    parts = [b'tag %s\n' % self.ref]
     if (write_marks and self.id):
-      file_.write(b'mark :%d\n' % self.id)
+      parts.append(b'mark :%d\n' % self.id)
     markfmt = b'from :%d\n' if isinstance(self.from_ref, int) else b'from %s\n'
-    file_.write(markfmt % self.from_ref)
+    parts.append(markfmt % self.from_ref)
     if self.tagger_name:
-      file_.write(b'tagger %s <%s> ' % (self.tagger_name, self.tagger_email))
-      file_.write(self.tagger_date)
-      file_.write(b'\n')
-    file_.write(b'data %d\n%s' % (len(self.message), self.message))
-    file_.write(b'\n')
+      parts.append(b'tagger %s <%s> ' % (self.tagger_name, self.tagger_email))
+      parts.append(self.tagger_date)
+      parts.append(b'\n')
+    parts.append(b'data %d\n' % len(self.message))
+    parts.append(self.message)
+    parts.append(b'\n')
+    file_.write(b''.join(parts))
 
 class Progress(_GitElement):
   """
@@ -896,6 +1225,7 @@ class Progress(_GitElement):
   element only contains a progress message, which is printed by fast-import
   when it processes the progress output.
   """
+  __slots__ = ('message',)
 
   def __init__(self, message):
     _GitElement.__init__(self)
@@ -912,8 +1242,7 @@ class Progress(_GitElement):
     """
     self.dumped = 1
 
-    file_.write(b'progress %s\n' % self.message)
-    file_.write(b'\n')
+    file_.write(b'progress %s\n\n' % self.message)
 
 class Checkpoint(_GitElement):
   """
@@ -922,6 +1251,7 @@ class Checkpoint(_GitElement):
   packfile, start a new one, and to save out all current branch refs, tags
   and marks.
   """
+  __slots__ = ()
 
   def __init__(self):
     _GitElement.__init__(self)
@@ -935,14 +1265,14 @@ class Checkpoint(_GitElement):
     """
     self.dumped = 1
 
-    file_.write(b'checkpoint\n')
-    file_.write(b'\n')
+    file_.write(b'checkpoint\n\n')
 
 class LiteralCommand(_GitElement):
   """
   This class defines our representation of commands. The literal command
   includes only a single line, and is not processed in any special way.
   """
+  __slots__ = ('line',)
 
   def __init__(self, line):
     _GitElement.__init__(self)
@@ -967,6 +1297,7 @@ class Alias(_GitElement):
   alias element is the setting of one mark to the same sha1sum as another,
   usually because the newer mark corresponded to a pruned commit.
   """
+  __slots__ = ('ref', 'to_ref')
 
   def __init__(self, ref, to_ref):
     _GitElement.__init__(self)
@@ -1000,7 +1331,7 @@ class FastExportParser(object):
                tag_callback = None,   commit_callback = None,
                blob_callback = None,  progress_callback = None,
                reset_callback = None, checkpoint_callback = None,
-               done_callback = None):
+               done_callback = None,  early_blob_callback = None):
     # Members below simply store callback functions for the various git
     # elements
     self._tag_callback        = tag_callback
@@ -1011,6 +1342,17 @@ class FastExportParser(object):
     self._checkpoint_callback = checkpoint_callback
     self._done_callback       = done_callback
 
+    # If early_blob_callback is given, it is called on each blob as soon as
+    # the blob is parsed, while calling blob_callback on it and dumping it
+    # are deferred until we reach the end of the run of consecutive blobs
+    # (fast-export emits the blobs a commit needs right before the commit).
+    # That lets early_blob_callback start expensive work on many blobs at
+    # once, while the blobs are still handled and output in their original
+    # order.
+    self._early_blob_callback = early_blob_callback
+    self._pending_blobs = []
+    self._pending_blobs_size = 0
+
     # Keep track of which refs appear from the export, and which make it to
     # the import (pruning of empty commits, renaming of refs, and creating
     # new manual objects and inserting them can cause these to differ).
@@ -1053,6 +1395,20 @@ class FastExportParser(object):
     for user in (b'author', b'committer', b'tagger'):
       self._user_regexes[user] = re.compile(user + b' (.*?) <(.*?)> (.*)\n$')
 
+    # Handlers for the top-level commands, keyed by their first token (see
+    # run()); anything not found here goes through the slower checks there
+    self._command_handlers = {
+      b'blob':       self._parse_blob,
+      b'reset':      self._parse_reset,
+      b'commit':     self._parse_commit,
+      b'tag':        self._parse_tag,
+      b'progress':   self._parse_progress,
+      b'checkpoint': self._parse_checkpoint,
+      b'feature':    self._parse_literal_command,
+      b'option':     self._parse_literal_command,
+      b'done':       self._parse_done,
+    }
+
   def _advance_currentline(self):
     """
     Grab the next line of input
@@ -1065,7 +1421,14 @@ class FastExportParser(object):
     next line; return None otherwise
     """
     mark = None
-    matches = self._mark_re.match(self._currentline)
+    line = self._currentline
+    # Fast path for the common case, falling back to the regex otherwise
+    if line.startswith(b'mark :') and line[6:-1].isdigit() and \
+       line[-1:] == b'\n':
+      mark = int(line[6:-1])
+      self._advance_currentline()
+      return mark
+    matches = self._mark_re.match(line)
     if matches:
       mark = int(matches.group(1))
       self._advance_currentline()
@@ -1079,6 +1442,16 @@ class FastExportParser(object):
     refname arg.
     """
     orig_baseref, baseref = None, None
+    line = self._currentline
+    # Fast path for references to marks, falling back to the regexes
+    # for everything else
+    start = len(refname) + 2
+    if line[0:start] == refname + b' :' and line[start:-1].isdigit() and \
+       line[-1:] == b'\n':
+      orig_baseref = int(line[start:-1])
+      baseref = _IDS.translate(orig_baseref)
+      self._advance_currentline()
+      return orig_baseref, baseref
     rule, altrule = self._parent_regexes[refname]
     matches = rule.match(self._currentline)
     if matches:
@@ -1163,7 +1536,12 @@ class FastExportParser(object):
     current-line does not match, so current-line will always be advanced if
     this method returns.
     """
-    matches = self._refline_regexes[refname].match(self._currentline)
+    line = self._currentline
+    start = len(refname) + 1
+    if line[0:start] == refname + b' ' and line[-1:] == b'\n':
+      self._advance_currentline()
+      return line[start:-1]
+    matches = self._refline_regexes[refname].match(line)
     if not matches:
       raise SystemExit(_("Malformed %(refname)s line: '%(line)s'") %
                        ({'refname': refname, 'line':self._currentline})
@@ -1177,8 +1555,19 @@ class FastExportParser(object):
     Get user name, email, datestamp from current-line. Current-line will
     be advanced.
     """
+    line = self._currentline
+    # Fast path: split on the first ' <' and the first '> ' after it, which
+    # is what the regex does too
+    start = len(usertype) + 1
+    lt = line.find(b' <', start)
+    gt = line.find(b'> ', lt + 2)
+    if line[0:start] == usertype + b' ' and lt != -1 and gt != -1 and \
+       line[-1:] == b'\n':
+      self._advance_currentline()
+      return (line[start:lt], line[lt+2:gt], line[gt+2:-1])
+
     user_regex = self._user_regexes[usertype]
-    (name, email, when) = user_regex.match(self._currentline).groups()
+    (name, email, when) = user_regex.match(line).groups()
 
     self._advance_currentline()
     return (name, email, when)
@@ -1230,6 +1619,22 @@ class FastExportParser(object):
     if self._lfs_object_tracker:
       self._lfs_object_tracker.check_blob_data(data, blob.old_id, True)
 
+    if self._early_blob_callback:
+      self._early_blob_callback(blob)
+      self._pending_blobs.append(blob)
+      self._pending_blobs_size += len(data)
+      # Avoid holding too much blob data in memory at once
+      if len(self._pending_blobs) >= 1024 or \
+         self._pending_blobs_size >= 64*1024*1024:
+        self._flush_pending_blobs()
+      return
+
+    self._finish_blob(blob)
+
+  def _finish_blob(self, blob):
+    """
+    Hand a parsed blob to the blob callback, then dump it to _output.
+    """
     # Call any user callback to allow them to use/modify the blob
     if self._blob_callback:
       self._blob_callback(blob)
@@ -1238,6 +1643,16 @@ class FastExportParser(object):
     if not blob.dumped:
       blob.dump(self._output)
 
+  def _flush_pending_blobs(self):
+    """
+    Finish handling the blobs deferred by an early_blob_callback.
+    """
+    pending = self._pending_blobs
+    self._pending_blobs = []
+    self._pending_blobs_size = 0
+    for blob in pending:
+      self._finish_blob(blob)
+
   def _parse_reset(self):
     """
     Parse input data into a Reset object. Once the Reset has been created,
@@ -1500,6 +1915,17 @@ class FastExportParser(object):
     if not command.dumped:
       command.dump(self._output)
 
+  def _parse_done(self):
+    """
+    Handle the 'done' command, which ends the stream.
+    """
+    if self._done_callback:
+      self._done_callback()
+    self._parse_literal_command()
+    # Prevent confusion from others writing additional stuff that'll just
+    # be ignored
+    self._output.close()
+
   def insert(self, obj):
     assert not obj.dumped
     obj.dump(self._output)
@@ -1510,15 +1936,31 @@ class FastExportParser(object):
 
   def run(self, input, output):
     """
-    This method filters fast export output.
+    This method filters fast export output.  input can be any object
+    providing readline() and read(size) methods that return bytes, such as
+    a pipe, a file, or an InputFileBackup wrapping one of those.
     """
     # Set input. If no args provided, use stdin.
     self._input = input
     self._output = output
 
-    # Run over the input and do the filtering
+    # Run over the input and do the filtering.  Most commands are found by
+    # looking up their first token (for lines without a space, slicing up
+    # to find()'s -1 conveniently drops the trailing newline); anything
+    # else goes through the checks below.
+    handlers = self._command_handlers
+    parse_blob = self._parse_blob
     self._advance_currentline()
     while self._currentline:
+      line = self._currentline
+      handler = handlers.get(line[0:line.find(b' ')])
+      if handler:
+        if self._pending_blobs and handler != parse_blob:
+          self._flush_pending_blobs()
+        handler()
+        continue
+      if self._pending_blobs and not self._currentline.startswith(b'blob'):
+        self._flush_pending_blobs()
       if   self._currentline.startswith(b'blob'):
         self._parse_blob()
       elif self._currentline.startswith(b'reset'):
@@ -1536,12 +1978,7 @@ class FastExportParser(object):
       elif self._currentline.startswith(b'option'):
         self._parse_literal_command()
       elif self._currentline.startswith(b'done'):
-        if self._done_callback:
-          self._done_callback()
-        self._parse_literal_command()
-        # Prevent confusion from others writing additional stuff that'll just
-        # be ignored
-        self._output.close()
+        self._parse_done()
       elif self._currentline.startswith(b'#'):
         self._parse_literal_command()
       elif self._currentline.startswith(b'get-mark') or \
@@ -1550,6 +1987,8 @@ class FastExportParser(object):
         raise SystemExit(_("Unsupported command: '%s'") % self._currentline)
       else:
         raise SystemExit(_("Could not parse line: '%s'") % self._currentline)
+    if self._pending_blobs:
+      self._flush_pending_blobs()
 
   def get_exported_and_imported_refs(self):
     return self._exported_refs, self._imported_refs
@@ -1693,36 +2132,151 @@ class GitUtils(object):
                 for item in output.strip().split(b"\0") if item)
 
   @staticmethod
-  def get_blob_sizes(quiet = False):
+  def _object_store_key():
+    '''
+    Returns a hash of the names, sizes and modification times of the
+    packfiles and loose object directories of the repository, which changes
+    whenever objects are added or removed.  Returns None if objects could
+    come from elsewhere, were modified too recently for modification times
+    to be trusted, or cannot be looked at.
+    '''
+    if 'GIT_OBJECT_DIRECTORY' in os.environ or \
+       'GIT_ALTERNATE_OBJECT_DIRECTORIES' in os.environ:
+      return None
+    # Linked worktrees share the object directory of the main repository,
+    # which is not inside their git directory
+    objects_dir = subproc.check_output('git rev-parse --git-path objects'
+                                       .split()).strip()
+    stats = []
+    try:
+      if os.path.exists(os.path.join(objects_dir, b'info', b'alternates')):
+        return None
+      for entry in os.scandir(objects_dir):
+        if entry.name == b'pack':
+          stats.extend((b'pack/' + x.name, x.stat())
+                       for x in os.scandir(entry.path)
+                       if x.name.endswith(b'.pack'))
+        elif len(entry.name) == 2 and entry.is_dir():
+          stats.append((entry.name, entry.stat()))
+    except OSError:
+      return None
+    # Like git's "racily clean" index entries, something modified within
+    # the last couple seconds could be modified again without its
+    # modification time changing
+    racy_time = (time.time() - 2) * 1e9
+    h = hashlib.sha1(b'blob-sizes-v2\0')
+    for name, st in sorted(stats):
+      if st.st_mtime_ns > racy_time:
+        return None
+      h.update(b'%s %d %d\0' % (name, st.st_size, st.st_mtime_ns))
+    return h.digest()
+
+  @staticmethod
+  def _blob_sizes(quiet, save_cache):
+    '''
+    Yields (sha, size, disk size) for every blob in the repository.  If
+    save_cache is True, these are saved to .git/filter-repo/blob-sizes; if
+    they were saved there before, they are read back from there rather than
+    from `git cat-file` if no objects have changed since.
+    '''
+    # The cache is a list of (binary sha, size, disk size) records,
+    # followed by the object store key and the length of the binary shas.
+    # Anything unexpected in it just means asking `git cat-file` instead.
+    git_dir = GitUtils.determine_git_dir(b'.')
+    key = GitUtils._object_store_key()
+    results_dir = os.path.join(git_dir, b'filter-repo')
+    cache_file = os.path.join(results_dir, b'blob-sizes')
+    trailer = struct.Struct('<20sB')
+    records = None
+    if key:
+      try:
+        with open(cache_file, 'br') as f:
+          size = os.fstat(f.fileno()).st_size - trailer.size
+          if size >= 0:
+            f.seek(size)
+            cache_key, oid_len = trailer.unpack(f.read(trailer.size))
+            record = struct.Struct('<%dsQQ' % oid_len)
+            if cache_key == key and oid_len in (20, 32) and \
+               size % record.size == 0:
+              f.seek(0)
+              records = f.read(size)
+              if len(records) != size:
+                records = None
+      except (OSError, struct.error):
+        records = None
+    if records is not None:
+      for sha, objsize, objdisksize in record.iter_unpack(records):
+        yield (sha.hex().encode(), objsize, objdisksize)
+      return
+
     blob_size_progress = ProgressWriter()
     num_blobs = 0
     processed_blobs_msg = _("Processed %d blob sizes")
 
-    # Get sizes of blobs by sha1
-    cmd = '--batch-check=%(objectname) %(objecttype) ' + \
-          '%(objectsize) %(objectsize:disk)'
-    cf = subproc.Popen(['git', 'cat-file', '--batch-all-objects', cmd],
+    out = None
+    if key and save_cache:
+      try:
+        if not os.path.isdir(results_dir):
+          os.mkdir(results_dir)
+        out = open(cache_file + b'.tmp', 'bw')
+      except OSError:
+        pass
+
+    # Get sizes of blobs by sha1; objects are listed in pack order with
+    # --unordered, which is faster
+    cmd = '--batch-check=%(objecttype) %(objectsize) ' + \
+          '%(objectsize:disk) %(objectname)'
+    cf = subproc.Popen(['git', 'cat-file', '--batch-all-objects',
+                        '--unordered', cmd],
                        bufsize = -1,
                        stdout = subprocess.PIPE)
-    unpacked_size = {}
-    packed_size = {}
+    record = None
     for line in cf.stdout:
       try:
-        sha, objtype, objsize, objdisksize = line.split()
-        objsize, objdisksize = int(objsize), int(objdisksize)
+        objtype, objsize, objdisksize, sha = line.split()
         if objtype == b'blob':
-          unpacked_size[sha] = objsize
-          packed_size[sha] = objdisksize
+          objsize, objdisksize = int(objsize), int(objdisksize)
+          if out:
+            record = record or struct.Struct('<%dsQQ' % (len(sha) // 2))
+            out.write(record.pack(bytes.fromhex(sha.decode()), objsize,
+                                  objdisksize))
+          yield (sha, objsize, objdisksize)
           num_blobs += 1
       except ValueError: # pragma: no cover
         sys.stderr.write(_("Error: unexpected `git cat-file` output: \"%s\"\n") % line)
       if not quiet:
         blob_size_progress.show(processed_blobs_msg % num_blobs)
-    cf.wait()
+    if cf.wait() == 0 and out:
+      oid_len = record.size - 16 if record else 20
+      out.write(trailer.pack(key, oid_len))
+      out.close()
+      os.replace(cache_file + b'.tmp', cache_file)
+    elif out:
+      out.close()
+      os.remove(cache_file + b'.tmp')
     if not quiet:
       blob_size_progress.finish()
+
+  @staticmethod
+  def get_blob_sizes(quiet = False, save_cache = False):
+    unpacked_size = {}
+    packed_size = {}
+    for sha, objsize, objdisksize in GitUtils._blob_sizes(quiet, save_cache):
+      unpacked_size[sha] = objsize
+      packed_size[sha] = objdisksize
     return unpacked_size, packed_size
 
+  @staticmethod
+  def get_large_blobs(max_size, quiet = False, save_cache = False):
+    '''
+    Returns the set of ids of blobs bigger than max_size bytes.  Unlike
+    get_blob_sizes(), only those blobs are remembered, which keeps memory
+    usage small for repositories with many blobs.
+    '''
+    return set(sha for sha, objsize, objdisksize
+               in GitUtils._blob_sizes(quiet, save_cache)
+               if objsize > max_size)
+
   @staticmethod
   def get_file_changes(repo, parent_hash, commit_hash):
     """
@@ -1944,6 +2498,25 @@ EXAMPLES
         dest='report_dir',
         help=_("Directory to write report, defaults to GIT_DIR/filter_repo/analysis,"
                "refuses to run if exists, --force delete existing dir first."))
+    analyze.add_argument('--report-format', choices=['text', 'sqlite'],
+        default='text',
+        help=_("Write reports as text files (the default), or as tables of a "
+               "report.sqlite database in the report directory for other "
+               "tools to query.  The README is written either way."))
+    analyze.add_argument('--report-top', type=int, metavar='N',
+        help=_("Only report the N largest directories, extensions, paths "
+               "and blobs in each listing, instead of all of them.  Much "
+               "faster for repositories with very many paths."))
+    analyze.add_argument('--incremental', action='store_true',
+        help=_("Save the results of the analysis in the report directory, "
+               "and if a previous --analyze --incremental run saved them "
+               "there, reuse them and only analyze commits added since "
+               "then, replacing its reports.  Analyzes all history if the "
+               "previous results cannot be used, e.g. because history was "
+               "rewritten.  Since newer commits are analyzed after older "
+               "ones rather than in topological order, which paths are "
+               "reported as deleted or renamed can differ slightly from a "
+               "full analysis."))
 
     path = parser.add_argument_group(title=_("Filtering based on paths "
                                              "(see also --filename-callback)"),
@@ -1978,6 +2551,12 @@ EXAMPLES
         help=_("Match on file base name instead of full path from the top "
                "of the repo.  Incompatible with --path-rename, and "
                "incompatible with matching against directory names."))
+    path.add_argument('--max-cached-paths', metavar='COUNT', type=int,
+                      default=0,
+        help=_("Limit how many paths the results of path filtering and "
+               "renaming are remembered for, to reduce memory usage on "
+               "repositories with huge numbers of distinct paths.  Must be "
+               "at least 2; the default is no limit."))
 
     rename = parser.add_argument_group(title=_("Renaming based on paths "
                                              "(see also --filename-callback)"))
@@ -2019,6 +2598,12 @@ EXAMPLES
                "end the line with '==>' and some replacement text to "
                "choose a replacement choice other than the default of '{}'."
                .format(decode(FilteringOptions.default_replace_text))))
+    contents.add_argument('--replace-text-cache', metavar='SIZE', default=0,
+        help=_("Remember the results of --replace-text for each blob in "
+               "a cache under .git/filter-repo/, so that later runs with "
+               "the same expressions can skip blobs they have already "
+               "processed.  SIZE (e.g. '500M', '2G') limits the size of "
+               "the cache; least recently used entries are dropped first."))
     contents.add_argument('--strip-blobs-bigger-than', metavar='SIZE',
                           dest='max_blob_size', default=0,
         help=_("Strip blobs (files) bigger than specified size (e.g. '5M', "
@@ -2251,6 +2836,11 @@ EXAMPLES
                "to include original-oid directives)."))
     misc.add_argument('--quiet', action='store_true',
         help=_("Pass --quiet to other git commands called"))
+    misc.add_argument('--jobs', '-j', type=int, default=1, metavar='N',
+        help=_("Use N worker processes for rewriting file contents with "
+               "--replace-text, or N diff-tree processes with --analyze.  "
+               "The filtered history and reports are identical "
+               "regardless of the number of jobs.  Defaults to 1."))
     return parser
 
   @staticmethod
@@ -2260,6 +2850,8 @@ EXAMPLES
                          "it's a read-only operation."))
     if args.analyze and args.stdin:
       raise SystemExit(_("Error: --analyze is incompatible with --stdin."))
+    if args.incremental and not args.analyze:
+      raise SystemExit(_("Error: --incremental requires --analyze."))
     # If no path_changes are found, initialize with empty list but mark as
     # not inclusive so that all files match
     if args.path_changes == None:
@@ -2276,6 +2868,14 @@ EXAMPLES
         if any(x[0] == 'rename' for x in args.path_changes):
           raise SystemExit(_("Error: --use-base-name and --path-rename are "
                              "incompatible."))
+    if args.max_cached_paths < 0:
+      raise SystemExit(_("Error: --max-cached-paths must not be negative"))
+    if args.max_cached_paths == 1:
+      # A path needs one entry for its directory and one for itself
+      raise SystemExit(_("Error: --max-cached-paths must be 0 (no limit) "
+                         "or at least 2"))
+    args.path_filter = PathFilter(args.path_changes, args.use_base_name,
+                                  args.inclusive)
     # Also throw some sanity checks on git version here;
     # PERF: remove these checks once new enough git versions are common
     p = subproc.Popen('git fast-export -h'.split(),
@@ -2315,21 +2915,35 @@ EXAMPLES
         raise SystemExit(_("Error: need git >= 2.36.0"))
     # End of sanity checks on git version
     if args.max_blob_size:
-      suffix = args.max_blob_size[-1]
-      if suffix not in '1234567890':
-        mult = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
-        if suffix not in mult:
-          raise SystemExit(_("Error: could not parse --strip-blobs-bigger-than"
-                             " argument %s")
-                           % args.max_blob_size)
-        args.max_blob_size = int(args.max_blob_size[0:-1]) * mult[suffix]
-      else:
-        args.max_blob_size = int(args.max_blob_size)
+      args.max_blob_size = FilteringOptions.parse_size(
+        args.max_blob_size,
+        _("Error: could not parse --strip-blobs-bigger-than"
+          " argument %s"))
+    if args.replace_text_cache:
+      if not args.replace_text:
+        raise SystemExit(_("Error: --replace-text-cache requires --replace-text"))
+      args.replace_text_cache = FilteringOptions.parse_size(
+        args.replace_text_cache,
+        _("Error: could not parse --replace-text-cache argument %s"))
+    if args.jobs < 1:
+      raise SystemExit(_("Error: --jobs must be at least 1"))
+    if args.report_top is not None and args.report_top < 1:
+      raise SystemExit(_("Error: --report-top must be at least 1"))
     if args.file_info_callback and (
         args.stdin or args.blob_callback or args.filename_callback):
       raise SystemExit(_("Error: --file-info-callback is incompatible with "
                          "--stdin, --blob-callback,\nand --filename-callback."))
 
+  @staticmethod
+  def parse_size(size, error_msg):
+    suffix = size[-1]
+    if suffix not in '1234567890':
+      mult = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+      if suffix not in mult:
+        raise SystemExit(error_msg % size)
+      return int(size[0:-1]) * mult[suffix]
+    return int(size)
+
   @staticmethod
   def get_replace_text(filename):
     replace_literals = []
@@ -2358,7 +2972,13 @@ EXAMPLES
           if not line:
             continue
           replace_literals.append((line, replacement))
-    return {'literals': replace_literals, 'regexes':  replace_regexes}
+    # With only a few literals, calling bytes.replace() for each is faster
+    # than anything fancier
+    literal_replacer = None
+    if len(replace_literals) >= 20:
+      literal_replacer = LiteralReplacer(replace_literals)
+    return {'literals': replace_literals, 'regexes':  replace_regexes,
+            'literal_replacer': literal_replacer}
 
   @staticmethod
   def get_paths_from_file(filename):
@@ -2452,6 +3072,351 @@ EXAMPLES
       args.refs = ['--all']
     return args
 
+class PathFilter(object):
+  """
+  Applies the filtering and renaming rules of args.path_changes to paths.
+
+  The rules are compiled once, when the PathFilter is created.  Each run of
+  consecutive filter rules becomes a set of the paths from 'match' rules,
+  checked against a path and each of its leading directories, plus one
+  combined regex for the 'glob' rules and another for the 'regex' rules.
+  Renames are applied in order between runs of filter rules, as before.
+  """
+
+  def __init__(self, path_changes, use_base_name, inclusive):
+    # What we were built from, so callers can tell if we are out of date
+    self.path_changes = [list(x) for x in path_changes]
+    self.use_base_name = use_base_name
+    self.inclusive = inclusive
+
+    # A list of ('filter', compiled_filters) and
+    # ('rename', match_type, (match, repl)) steps
+    self._steps = []
+    filters = []
+    for (mod_type, match_type, path_exp) in path_changes:
+      if mod_type == 'filter':
+        assert match_type in ('match', 'glob', 'regex')
+        filters.append((match_type, path_exp))
+        continue
+      assert match_type in ('match','regex') # glob was translated to regex
+      if filters:
+        self._steps.append(('filter', self._compile_filters(filters)))
+        filters = []
+      self._steps.append(('rename', match_type, path_exp))
+    if filters:
+      self._steps.append(('filter', self._compile_filters(filters)))
+
+    # If the rules just select the files below one directory and/or move
+    # all files into some directory, as --subdirectory-filter and
+    # --to-subdirectory-filter do, then newname() amounts to replacing
+    # one prefix with another; see prefix_change.
+    self.prefix_change = self._find_prefix_change()
+
+    # If the only rules are 'match' filters, all files below a directory
+    # often get the same answer; see directory_verdict().  Record every
+    # leading directory of those rules to help.
+    self._match_only = not use_base_name and \
+      all(mod_type == 'filter' and match_type == 'match'
+          for (mod_type, match_type, path_exp) in self.path_changes)
+    self._match_paths = set()
+    if self._match_only:
+      self._match_paths.update(x[2] for x in self.path_changes)
+    self._match_path_dirs = set()
+    for path in self._match_paths:
+      index = path.find(b'/')
+      while index != -1:
+        self._match_path_dirs.add(path[0:index])
+        index = path.find(b'/', index+1)
+
+  def _find_prefix_change(self):
+    '''
+    Returns (old_prefix, new_prefix) if newname(path) is the same as
+      new_prefix + path[len(old_prefix):] if path.startswith(old_prefix)
+                                          else None
+    for all paths, or None if we cannot tell that it is.
+    '''
+    if self.use_base_name:
+      return None
+    changes = [(mod_type, match_type, tuple(path_exp) if mod_type == 'rename'
+                                      else path_exp)
+               for (mod_type, match_type, path_exp) in self.path_changes]
+    old_prefix = new_prefix = b''
+    if self.inclusive:
+      # Selecting the files below a directory, then moving them to toplevel
+      if len(changes) < 2 or changes[0][0:2] != ('filter', 'match'):
+        return None
+      old_prefix = changes[0][2]
+      if not old_prefix.endswith(b'/') or \
+         changes[1] != ('rename', 'match', (old_prefix, b'')):
+        return None
+      changes = changes[2:]
+    if changes and changes[0][0:2] == ('rename', 'match') and \
+       changes[0][2][0] == b'':
+      # Moving all files into a directory
+      new_prefix = changes[0][2][1]
+      changes = changes[1:]
+    if changes or not (old_prefix or new_prefix):
+      return None
+    return (old_prefix, new_prefix)
+
+  def pathspecs(self):
+    '''
+    Returns a list of git pathspecs matching at least every path for which
+    newname() does not return None, or None if we cannot build one that
+    excludes anything, or it would be too long to pass on a command line.
+    '''
+    if self.use_base_name:
+      return None
+    pathspecs = []
+    renamed = False
+    for (mod_type, match_type, path_exp) in self.path_changes:
+      if mod_type == 'rename':
+        renamed = True
+        continue
+      if renamed:
+        # Filters after a rename see the renamed paths; we can only ignore
+        # them if they would exclude more paths
+        if self.inclusive:
+          return None
+        continue
+      if not self.inclusive:
+        # Excluding fewer paths than we would is fine, so just skip
+        # anything we cannot express exactly
+        if match_type == 'match' and path_exp:
+          pathspecs.append(b':(exclude,literal)' + path_exp)
+      elif match_type == 'match' and path_exp:
+        pathspecs.append(b':(literal)' + path_exp)
+      elif match_type == 'glob' and b'[' not in path_exp and \
+           b'\\' not in path_exp:
+        # With no magic, pathspecs use fnmatch() rules, where '*' can match
+        # slashes; but bracket expressions and escaping differ
+        pathspecs.append(b':()' + path_exp)
+      else:
+        return None
+    if len(pathspecs) > self._max_pathspecs or \
+       sum(len(x) + 1 for x in pathspecs) > self._max_pathspecs_size:
+      return None
+    return pathspecs or None
+
+  # Limits on the pathspecs returned by pathspecs(), staying well within
+  # the command line length limits of the platforms we support (Windows
+  # allows just 32767 characters in total)
+  _max_pathspecs = 1000
+  _max_pathspecs_size = 16384
+
+  def is_current(self, path_changes, use_base_name, inclusive):
+    return (self.path_changes == path_changes and
+            self.use_base_name == use_base_name and
+            self.inclusive == inclusive)
+
+  @staticmethod
+  def _combine(patterns):
+    '''
+    Return a list of regexes which together search for any of patterns;
+    a single combined regex if possible.
+    '''
+    if len(patterns) < 2:
+      return [re.compile(x) for x in patterns]
+    try:
+      return [re.compile(b'|'.join(b'(?:%s)' % x for x in patterns))]
+    except (RecursionError, OverflowError, re.error):
+      return [re.compile(x) for x in patterns]
+
+  @staticmethod
+  def _compile_filters(filters):
+    paths = set()
+    globs = []
+    regexes = []
+    separate_regexes = []
+    for match_type, path_exp in filters:
+      if match_type == 'match':
+        paths.add(path_exp)
+      elif match_type == 'glob':
+        # Same translation fnmatch.fnmatch() uses for bytes
+        pattern = os.path.normcase(path_exp).decode('iso-8859-1')
+        globs.append(b'\\A' + fnmatch.translate(pattern).encode('iso-8859-1'))
+      elif path_exp.groups or path_exp.flags & ~re.ASCII:
+        # Backreferences and flags would not survive combining
+        separate_regexes.append(path_exp)
+      else:
+        regexes.append(path_exp.pattern)
+    return (paths, PathFilter._combine(globs),
+            PathFilter._combine(regexes) + separate_regexes)
+
+  @staticmethod
+  def filename_matches(path_expression, pathname):
+    ''' Returns whether path_expression matches pathname or a leading
+        directory thereof, allowing path_expression to not have a trailing
+        slash even if it is meant to match a leading directory. '''
+    if path_expression == b'':
+      return True
+    n = len(path_expression)
+    if (pathname.startswith(path_expression) and
+        (path_expression[n-1:n] == b'/' or
+         len(pathname) == n or
+         pathname[n:n+1] == b'/')):
+      return True
+    return False
+
+  @staticmethod
+  def _filters_match(compiled_filters, pathname):
+    paths, globs, regexes = compiled_filters
+    if paths:
+      # Equivalent to filename_matches() for each path in paths
+      if b'' in paths or pathname in paths:
+        return True
+      index = pathname.find(b'/')
+      while index != -1:
+        if pathname[0:index] in paths or pathname[0:index+1] in paths:
+          return True
+        index = pathname.find(b'/', index+1)
+    if globs:
+      normalized = os.path.normcase(pathname)
+      if any(glob.match(normalized) for glob in globs):
+        return True
+    return any(regex.search(pathname) for regex in regexes)
+
+  def directory_verdict(self, dirname):
+    '''
+    Returns True if newname() leaves every path below dirname unchanged,
+    False if newname() returns None for every path below dirname, or None
+    if the answer may differ between paths below dirname.  dirname is b''
+    for the toplevel directory.
+    '''
+    if not self._match_only:
+      return None
+    paths = self._match_paths
+    wanted = (b'' in paths)
+    if dirname and not wanted:
+      # Does some rule match dirname or one of its leading directories?
+      index = dirname.find(b'/')
+      while index != -1 and not wanted:
+        wanted = (dirname[0:index] in paths or dirname[0:index+1] in paths)
+        index = dirname.find(b'/', index+1)
+      wanted = wanted or dirname in paths or dirname+b'/' in paths
+    if not wanted and (dirname in self._match_path_dirs or
+                       (not dirname and paths)):
+      # Some rule matches a path within dirname, but not all of dirname
+      return None
+    return (wanted == self.inclusive)
+
+  def newname(self, pathname):
+    ''' Applies filtering and rename changes to pathname, returning any of
+        None (file isn't wanted), original filename (file is wanted with
+        original name), or new filename. '''
+    wanted = False
+    full_pathname = pathname
+    if self.use_base_name:
+      pathname = os.path.basename(pathname)
+    for step in self._steps:
+      if step[0] == 'filter':
+        if not wanted and self._filters_match(step[1], pathname):
+          wanted = True
+        continue
+      match_type, (match, repl) = step[1:]
+      if match_type == 'match' and self.filename_matches(match, full_pathname):
+        full_pathname = full_pathname.replace(match, repl, 1)
+        pathname = full_pathname # rename incompatible with use_base_name
+      if match_type == 'regex':
+        full_pathname = match.sub(repl, full_pathname)
+        pathname = full_pathname # rename incompatible with use_base_name
+    return full_pathname if (wanted == self.inclusive) else None
+
+class FilenameCache(object):
+  """
+  Remembers the new name (or None, if filtered out) of each path seen, as
+  computed by a PathFilter and an optional filename callback.
+
+  Entries are grouped by directory, so each directory name is stored once
+  and files within it are keyed by their base name.  Without a filename
+  callback, a directory whose files all get the same verdict from the
+  PathFilter (e.g. one entirely outside the paths selected by --path) is
+  stored as a single entry, without any per-file entries.  If max_entries
+  is nonzero, the oldest directories (possibly including the one being
+  added to) are forgotten whenever another entry would exceed that many;
+  it must then be at least 2, to hold a directory and one file in it.
+  """
+
+  def __init__(self, path_filter, filename_callback = None, max_entries = 0):
+    self._path_filter = path_filter
+    self._filename_callback = filename_callback
+    self._max_entries = max_entries
+
+    # Maps directory names (with a trailing slash, or b'' for the toplevel
+    # directory) to True (all files unchanged), False (all files filtered
+    # out), or a dict of basename -> new name, where a new name of True
+    # means unchanged
+    self._dirs = {}
+    self._num_entries = 0
+
+    self.hits = 0
+    self.misses = 0
+
+  def _compute(self, filename):
+    newname = self._path_filter.newname(filename)
+    if self._filename_callback:
+      newname = self._filename_callback(newname)
+    return newname
+
+  def _evict(self):
+    while self._dirs and self._num_entries >= self._max_entries // 2:
+      node = self._dirs.pop(next(iter(self._dirs)))
+      self._num_entries -= 1 + (len(node) if type(node) is dict else 0)
+
+  def _add_directory(self, dirname):
+    if self._max_entries and self._num_entries >= self._max_entries:
+      self._evict()
+    verdict = None
+    if not self._filename_callback:
+      verdict = self._path_filter.directory_verdict(dirname[0:-1])
+    node = {} if verdict is None else verdict
+    self._dirs[dirname] = node
+    self._num_entries += 1
+    return node
+
+  def newname(self, filename):
+    index = filename.rfind(b'/') + 1
+    node = self._dirs.get(filename[0:index])
+    if node is None:
+      node = self._add_directory(filename[0:index])
+    if node is True:
+      self.hits += 1
+      return filename
+    elif node is False:
+      self.hits += 1
+      return None
+    newname = node.get(filename[index:], False)
+    if newname is True:
+      self.hits += 1
+      return filename
+    elif newname is not False:
+      self.hits += 1
+      return newname
+    self.misses += 1
+    newname = self._compute(filename)
+    if self._max_entries and self._num_entries >= self._max_entries:
+      self._evict()
+      if filename[0:index] not in self._dirs:
+        node = self._add_directory(filename[0:index])
+    node[filename[index:]] = True if newname == filename else newname
+    self._num_entries += 1
+    return newname
+
+  def stats(self):
+    '''
+    Returns the number of directories and entries stored, and roughly how
+    much memory they take in bytes.
+    '''
+    size = sys.getsizeof(self._dirs)
+    for dirname, node in self._dirs.items():
+      size += sys.getsizeof(dirname)
+      if type(node) is dict:
+        size += sys.getsizeof(node)
+        size += sum(sys.getsizeof(x) for x in node)
+        size += sum(sys.getsizeof(x) for x in node.values()
+                    if type(x) is bytes)
+    return len(self._dirs), self._num_entries, size
+
 class RepoAnalyze(object):
 
   # First, several helper functions for analyze_commit()
@@ -2554,32 +3519,70 @@ class RepoAnalyze(object):
                          ) # pragma: no cover
 
   @staticmethod
-  def gather_data(args):
-    unpacked_size, packed_size = GitUtils.get_blob_sizes()
-    stats = {'names': collections.defaultdict(set),
-             'allnames' : set(),
-             'file_deletions': {},
-             'tree_deletions': {},
-             'equivalence': {},
-             'rename_history': collections.defaultdict(set),
-             'unpacked_size': unpacked_size,
-             'packed_size': packed_size,
-             'num_commits': 0}
-
-    # Setup the rev-list/diff-tree process
-    processed_commits_msg = _("Processed %d commits")
-    commit_parse_progress = ProgressWriter()
-    num_commits = 0
-    cmd = ('git rev-list --topo-order --reverse {}'.format(' '.join(args.refs)) +
-           ' | git diff-tree --stdin --always --root --format=%H%n%P%n%cd' +
-           ' --date=short -M -t -c --raw --combined-all-paths')
-    dtp = subproc.Popen(cmd, shell=True, bufsize=-1, stdout=subprocess.PIPE)
-    f = dtp.stdout
+  def diff_tree_outputs(args, exclude = ()):
+    '''
+    Yields the outputs of `git diff-tree` processes which together show
+    the commits of args.refs, other than ancestors of the commits in
+    exclude, in topological order.  With --jobs, each process diffs one of
+    several consecutive chunks of the commits in parallel, with all but the
+    first writing to a temporary file.
+    '''
+    diff_tree_cmd = ('git diff-tree --stdin --always --root' +
+                     ' --format=%H%n%P%n%cd --date=short' +
+                     ' -M -t -c --raw --combined-all-paths')
+    if args.jobs <= 1 and not exclude:
+      cmd = ('git rev-list --topo-order --reverse {}'.format(' '.join(args.refs)) +
+             ' | ' + diff_tree_cmd)
+      dtp = subproc.Popen(cmd, shell=True, bufsize=-1, stdout=subprocess.PIPE)
+      yield dtp.stdout
+
+      # Close the output, ensure rev-list|diff-tree pipeline completed
+      # successfully
+      dtp.stdout.close()
+      if dtp.wait():
+        raise SystemExit(_("Error: rev-list|diff-tree pipeline failed; see above.")) # pragma: no cover
+      return
+
+    commits = subproc.check_output(['git', 'rev-list', '--topo-order',
+                                    '--reverse', '--stdin'] + args.refs,
+                                   input = b''.join(b'^%s\n' % x
+                                                    for x in exclude))
+    commits = commits.splitlines(keepends=True)
+    if not commits:
+      return
+    chunk_size = -(-len(commits) // args.jobs)
+    processes = []
+    for index in range(0, len(commits), chunk_size):
+      with tempfile.TemporaryFile() as chunk:
+        chunk.writelines(commits[index:index+chunk_size])
+        chunk.seek(0)
+        # Stream the first chunk's output to our caller while the others
+        # are still being computed
+        output = tempfile.TemporaryFile() if processes else None
+        dtp = subproc.Popen(diff_tree_cmd.split(), bufsize=-1,
+                            stdin=chunk, stdout=output or subprocess.PIPE)
+      processes.append((dtp, output))
+    commits = None
+
+    for dtp, output in processes:
+      if output is None:
+        yield dtp.stdout
+        dtp.stdout.close()
+      if dtp.wait():
+        raise SystemExit(_("Error: diff-tree failed; see above.")) # pragma: no cover
+      if output is not None:
+        output.seek(0)
+        yield output
+        output.close()
+
+  @staticmethod
+  def parse_diff_tree_output(f):
+    '''
+    Yields (commit, parents, date, file_changes) for each commit shown in
+    the output of a diff_tree_outputs() process.
+    '''
     line = f.readline()
-    if not line:
-      raise SystemExit(_("Nothing to analyze; repository is empty."))
     cont = bool(line)
-    graph = AncestryGraph()
     while cont:
       commit = line.rstrip()
       parents = f.readline().split()
@@ -2615,42 +3618,145 @@ class RepoAnalyze(object):
           filenames = [PathQuoting.dequote(x) for x in splits[1:]]
           file_changes.append([modes, shas, change_types, filenames])
 
-      # If someone is trying to analyze a subset of the history, make sure
-      # to avoid dying on commits with parents that we haven't seen before
-      if args.refs:
-        graph.record_external_commits([p for p in parents
-                                       if not p in graph.value])
+      yield commit, parents, date, file_changes
 
-      # Analyze this commit and update progress
-      RepoAnalyze.analyze_commit(stats, graph, commit, parents, date,
-                                 file_changes)
-      num_commits += 1
-      commit_parse_progress.show(processed_commits_msg % num_commits)
+  @staticmethod
+  def load_snapshot(args, filename):
+    '''
+    Returns the snapshot of a previous gather_data() run saved in filename,
+    or an empty dict if it cannot be read, was for different refs, or any
+    commits it analyzed are no longer part of the history being analyzed.
+    '''
+    # The snapshot only holds plain data, and is checked before use, so a
+    # corrupt or tampered with file just means analyzing all history
+    stats_types = {'names': dict, 'allnames': set, 'file_deletions': dict,
+                   'tree_deletions': dict, 'equivalence': dict,
+                   'rename_history': dict, 'num_commits': int}
+    try:
+      with open(filename, 'br') as f:
+        snapshot = marshal.load(f)
+      if type(snapshot) is not dict or \
+         snapshot.get('version') != RepoAnalyze.snapshot_version or \
+         snapshot['refs'] != args.refs:
+        return {}
+      stats = snapshot['stats']
+      if type(stats) is not dict or stats.keys() != stats_types.keys() or \
+         any(type(stats[k]) is not t for (k, t) in stats_types.items()) or \
+         any(type(x) is not bytes for x in snapshot['tips']):
+        return {}
+      stats['names'] = collections.defaultdict(set, stats['names'])
+      stats['rename_history'] = collections.defaultdict(
+                                  set, stats['rename_history'])
+      snapshot['graph'] = AncestryGraph.from_state(snapshot['graph'])
+
+      # Count the previously analyzed commits we can no longer reach
+      output = subproc.check_output(['git', 'rev-list', '--count', '--stdin',
+                                     '--not'] + args.refs,
+                                    input = b'\n'.join(snapshot['tips']),
+                                    stderr = subprocess.DEVNULL)
+      if int(output) != 0:
+        return {}
+    except Exception:
+      return {}
+    return snapshot
+
+  @staticmethod
+  def save_snapshot(filename, snapshot):
+    # Save plain containers only, so that load_snapshot() never has to run
+    # code from the file; blob sizes are looked up afresh by every run
+    stats = {k: dict(v) if type(v) is collections.defaultdict else v
+             for (k, v) in snapshot['stats'].items()
+             if k not in ('unpacked_size', 'packed_size')}
+    with open(filename, 'bw') as f:
+      marshal.dump(dict(snapshot, stats = stats,
+                        graph = snapshot['graph'].get_state()), f)
+
+  # Bump whenever what gather_data() records in snapshots changes
+  snapshot_version = 2
+
+  @staticmethod
+  def gather_data(args, snapshot = None):
+    '''
+    Returns stats about the history of args.refs.  If a snapshot dict is
+    given, the stats, graph of commits and tips of args.refs are recorded in
+    it; and if it already has those from a previous run, they are updated
+    by only analyzing newer commits.
+    '''
+    if snapshot is None:
+      snapshot = {}
+    unpacked_size, packed_size = GitUtils.get_blob_sizes(save_cache = True)
+    stats = snapshot.get('stats')
+    if not stats:
+      stats = {'names': collections.defaultdict(set),
+               'allnames' : set(),
+               'file_deletions': {},
+               'tree_deletions': {},
+               'equivalence': {},
+               'rename_history': collections.defaultdict(set),
+               'num_commits': 0}
+    stats['unpacked_size'] = unpacked_size
+    stats['packed_size'] = packed_size
+    graph = snapshot.get('graph') or AncestryGraph()
+    exclude = snapshot.get('tips', [])
+
+    # Find out what we are about to analyze, so a later run will know where
+    # to pick up
+    tips = subproc.check_output(['git', 'rev-parse', '--revs-only'] +
+                                args.refs).split()
+    tips = [x for x in tips if not x.startswith(b'^')]
+
+    # Go through the output of the diff-tree process(es).  Even if several
+    # ran in parallel, we analyze commits in order, so the results do not
+    # depend on the number of jobs.
+    processed_commits_msg = _("Processed %d commits")
+    commit_parse_progress = ProgressWriter()
+    num_commits = stats['num_commits']
+    for f in RepoAnalyze.diff_tree_outputs(args, exclude):
+      for (commit, parents, date, file_changes) in \
+          RepoAnalyze.parse_diff_tree_output(f):
+        # Refs could have been updated after we looked up their tips, in
+        # which case a previous run may have analyzed this commit already
+        if commit in graph.value:
+          continue
+
+        # If someone is trying to analyze a subset of the history, make sure
+        # to avoid dying on commits with parents that we haven't seen before
+        if args.refs:
+          graph.record_external_commits([p for p in parents
+                                         if not p in graph.value])
+
+        # Analyze this commit and update progress
+        RepoAnalyze.analyze_commit(stats, graph, commit, parents, date,
+                                   file_changes)
+        num_commits += 1
+        commit_parse_progress.show(processed_commits_msg % num_commits)
+    if not num_commits:
+      raise SystemExit(_("Nothing to analyze; repository is empty."))
 
     # Show the final commits processed message and record the number of commits
     commit_parse_progress.finish()
     stats['num_commits'] = num_commits
 
-    # Close the output, ensure rev-list|diff-tree pipeline completed successfully
-    dtp.stdout.close()
-    if dtp.wait():
-      raise SystemExit(_("Error: rev-list|diff-tree pipeline failed; see above.")) # pragma: no cover
-
+    snapshot.update(version = RepoAnalyze.snapshot_version, refs = args.refs,
+                    tips = tips, stats = stats, graph = graph)
     return stats
 
   @staticmethod
-  def write_report(reportdir, stats):
-    def datestr(datetimestr):
-      return datetimestr if datetimestr else _('<present>').encode()
+  def write_report(reportdir, stats, report_format = 'text',
+                   report_top = None):
+    # Look up translations once, not once per line written
+    present = _('<present>').encode()
+    toplevel = _('<toplevel>').encode()
+    no_extension = _('<no extension>').encode()
 
-    def dirnames(path):
-      while True:
-        path = os.path.dirname(path)
-        yield path
-        if path == b'':
-          break
+    def datestr(datetimestr):
+      return datetimestr if datetimestr else present
 
-    # Compute aggregate size information for paths, extensions, and dirs
+    # Compute aggregate size information for paths, extensions, and dirs.
+    # Sizes are first summed per path, so that each distinct path is split
+    # into extension and directory only once no matter how many blobs it
+    # had, and each directory then passes its total up to its parent once
+    # rather than every path walking all of its leading directories.
     total_size = {'packed': 0, 'unpacked': 0}
     path_size = {'packed': collections.defaultdict(int),
                  'unpacked': collections.defaultdict(int)}
@@ -2658,17 +3764,38 @@ class RepoAnalyze(object):
                 'unpacked': collections.defaultdict(int)}
     dir_size = {'packed': collections.defaultdict(int),
                 'unpacked': collections.defaultdict(int)}
-    for sha in stats['names']:
-      size = {'packed': stats['packed_size'][sha],
-              'unpacked': stats['unpacked_size'][sha]}
-      for which in ('packed', 'unpacked'):
-        for name in stats['names'][sha]:
-          total_size[which] += size[which]
-          path_size[which][name] += size[which]
-          basename, ext = os.path.splitext(name)
-          ext_size[which][ext] += size[which]
-          for dirname in dirnames(name):
-            dir_size[which][dirname] += size[which]
+    path_packed, path_unpacked = path_size['packed'], path_size['unpacked']
+    ext_packed, ext_unpacked = ext_size['packed'], ext_size['unpacked']
+    dir_packed, dir_unpacked = dir_size['packed'], dir_size['unpacked']
+    for sha, names in stats['names'].items():
+      packed = stats['packed_size'][sha]
+      unpacked = stats['unpacked_size'][sha]
+      total_size['packed'] += packed * len(names)
+      total_size['unpacked'] += unpacked * len(names)
+      for name in names:
+        path_packed[name] += packed
+        path_unpacked[name] += unpacked
+    for name, packed in path_packed.items():
+      unpacked = path_unpacked[name]
+      basename, ext = os.path.splitext(name)
+      ext_packed[ext] += packed
+      ext_unpacked[ext] += unpacked
+      dirname = os.path.dirname(name)
+      dir_packed[dirname] += packed
+      dir_unpacked[dirname] += unpacked
+    # Roll directory totals up into their parents, deepest level first, so
+    # each directory's total is complete before it is added to its parent
+    levels = collections.defaultdict(set)
+    for dirname in dir_packed:
+      if dirname:
+        levels[dirname.count(b'/')].add(dirname)
+    for depth in reversed(range(max(levels, default=-1) + 1)):
+      for dirname in levels.pop(depth, ()):
+        parent = os.path.dirname(dirname)
+        if parent:
+          levels[depth - 1].add(parent)
+        dir_packed[parent] += dir_packed[dirname]
+        dir_unpacked[parent] += dir_unpacked[dirname]
 
     # Determine if and when extensions and directories were deleted
     ext_deleted_data = {}
@@ -2689,6 +3816,35 @@ class RepoAnalyze(object):
     for name in dir_size['packed']:
       dir_deleted_data[name] = stats['tree_deletions'].get(name, None)
 
+    # Order everything by reverse packed size.  Without report_top, each
+    # kind is sorted just once and the reports of all and of deleted items
+    # share that order.  With it, only the largest report_top of all and of
+    # deleted items are picked out, which avoids sorting everything.
+    def size_key(item):
+      return (item[1], item[0])
+    def by_reverse_size(sizes, deleted):
+      if report_top:
+        return (heapq.nlargest(report_top, sizes.items(), key=size_key),
+                heapq.nlargest(report_top,
+                               ((name, size) for (name, size) in sizes.items()
+                                if deleted.get(name)),
+                               key=size_key))
+      items = sorted(sizes.items(), key=size_key, reverse=True)
+      return (items, [(name, size) for (name, size) in items
+                      if deleted.get(name)])
+    dirs_by_size, deleted_dirs_by_size = \
+      by_reverse_size(dir_size['packed'], dir_deleted_data)
+    exts_by_size, deleted_exts_by_size = \
+      by_reverse_size(ext_size['packed'], ext_deleted_data)
+    paths_by_size, deleted_paths_by_size = \
+      by_reverse_size(path_size['packed'], stats['file_deletions'])
+    blobs_by_size = {sha: stats['packed_size'][sha] for sha in stats['names']}
+    if report_top:
+      blobs_by_size = heapq.nlargest(report_top, blobs_by_size.items(),
+                                     key=size_key)
+    else:
+      blobs_by_size = sorted(blobs_by_size.items(), key=size_key, reverse=True)
+
     with open(os.path.join(reportdir, b"README"), 'bw') as f:
       # Give a basic overview of this file
       f.write(b"== %s ==\n" % _("Overall Statistics").encode())
@@ -2776,6 +3932,25 @@ class RepoAnalyze(object):
         """)[1:]).encode())
       f.write(b"\n")
 
+    if report_format == 'sqlite':
+      if report_top:
+        # Keep rows for the largest deleted items too, in report order
+        def with_deleted(by_size, deleted_by_size):
+          return sorted(set(by_size).union(deleted_by_size), key=size_key,
+                        reverse=True)
+        dirs_by_size = with_deleted(dirs_by_size, deleted_dirs_by_size)
+        exts_by_size = with_deleted(exts_by_size, deleted_exts_by_size)
+        paths_by_size = with_deleted(paths_by_size, deleted_paths_by_size)
+      RepoAnalyze.write_sqlite_report(
+        os.path.join(reportdir, b"report.sqlite"), stats, total_size,
+        [(b'directories', dirs_by_size, dir_size['unpacked'],
+          dir_deleted_data),
+         (b'extensions', exts_by_size, ext_size['unpacked'], ext_deleted_data),
+         (b'paths', paths_by_size, path_size['unpacked'],
+          stats['file_deletions'])],
+        blobs_by_size)
+      return
+
     # Equivalence classes for names, so if folks only want to keep a
     # certain set of paths, they know the old names they want to include
     # too.
@@ -2796,24 +3971,21 @@ class RepoAnalyze(object):
       f.write(msg.encode())
       msg = _("Format: unpacked size, packed size, date deleted, directory name\n")
       f.write(msg.encode())
-      for dirname, size in sorted(dir_size['packed'].items(),
-                                  key=lambda x:(x[1],x[0]), reverse=True):
-        if (dir_deleted_data[dirname]):
-          f.write(b"  %10d %10d %-10s %s\n" % (dir_size['unpacked'][dirname],
-                                              size,
-                                              datestr(dir_deleted_data[dirname]),
-                                              dirname or _('<toplevel>').encode()))
+      for dirname, size in deleted_dirs_by_size:
+        f.write(b"  %10d %10d %-10s %s\n" % (dir_size['unpacked'][dirname],
+                                            size,
+                                            datestr(dir_deleted_data[dirname]),
+                                            dirname or toplevel))
 
     with open(os.path.join(reportdir, b"directories-all-sizes.txt"), 'bw') as f:
       f.write(("=== %s ===\n" % _("All directories by reverse size")).encode())
       msg = _("Format: unpacked size, packed size, date deleted, directory name\n")
       f.write(msg.encode())
-      for dirname, size in sorted(dir_size['packed'].items(),
-                                  key=lambda x:(x[1],x[0]), reverse=True):
+      for dirname, size in dirs_by_size:
         f.write(b"  %10d %10d %-10s %s\n" % (dir_size['unpacked'][dirname],
                                             size,
                                             datestr(dir_deleted_data[dirname]),
-                                            dirname or _("<toplevel>").encode()))
+                                            dirname or toplevel))
 
     # List extensions in reverse sorted order of unpacked size
     with open(os.path.join(reportdir, b"extensions-deleted-sizes.txt"), 'bw') as f:
@@ -2821,24 +3993,21 @@ class RepoAnalyze(object):
       f.write(msg.encode())
       msg = _("Format: unpacked size, packed size, date deleted, extension name\n")
       f.write(msg.encode())
-      for extname, size in sorted(ext_size['packed'].items(),
-                                  key=lambda x:(x[1],x[0]), reverse=True):
-        if (ext_deleted_data[extname]):
-          f.write(b"  %10d %10d %-10s %s\n" % (ext_size['unpacked'][extname],
-                                              size,
-                                              datestr(ext_deleted_data[extname]),
-                                              extname or _('<no extension>').encode()))
+      for extname, size in deleted_exts_by_size:
+        f.write(b"  %10d %10d %-10s %s\n" % (ext_size['unpacked'][extname],
+                                            size,
+                                            datestr(ext_deleted_data[extname]),
+                                            extname or no_extension))
 
     with open(os.path.join(reportdir, b"extensions-all-sizes.txt"), 'bw') as f:
       f.write(("=== %s ===\n" % _("All extensions by reverse size")).encode())
       msg = _("Format: unpacked size, packed size, date deleted, extension name\n")
       f.write(msg.encode())
-      for extname, size in sorted(ext_size['packed'].items(),
-                                  key=lambda x:(x[1],x[0]), reverse=True):
+      for extname, size in exts_by_size:
         f.write(b"  %10d %10d %-10s %s\n" % (ext_size['unpacked'][extname],
                                             size,
                                             datestr(ext_deleted_data[extname]),
-                                            extname or _('<no extension>').encode()))
+                                            extname or no_extension))
 
     # List files in reverse sorted order of unpacked size
     with open(os.path.join(reportdir, b"path-deleted-sizes.txt"), 'bw') as f:
@@ -2846,22 +4015,19 @@ class RepoAnalyze(object):
       f.write(msg.encode())
       msg = _("Format: unpacked size, packed size, date deleted, path name(s)\n")
       f.write(msg.encode())
-      for pathname, size in sorted(path_size['packed'].items(),
-                                   key=lambda x:(x[1],x[0]), reverse=True):
-        when = stats['file_deletions'].get(pathname, None)
-        if when:
-          f.write(b"  %10d %10d %-10s %s\n" % (path_size['unpacked'][pathname],
-                                              size,
-                                              datestr(when),
-                                              pathname))
+      for pathname, size in deleted_paths_by_size:
+        when = stats['file_deletions'][pathname]
+        f.write(b"  %10d %10d %-10s %s\n" % (path_size['unpacked'][pathname],
+                                            size,
+                                            datestr(when),
+                                            pathname))
 
     with open(os.path.join(reportdir, b"path-all-sizes.txt"), 'bw') as f:
       msg = "=== %s ===\n" % _("All paths by reverse accumulated size")
       f.write(msg.encode())
       msg = _("Format: unpacked size, packed size, date deleted, path name\n")
       f.write(msg.encode())
-      for pathname, size in sorted(path_size['packed'].items(),
-                                   key=lambda x:(x[1],x[0]), reverse=True):
+      for pathname, size in paths_by_size:
         when = stats['file_deletions'].get(pathname, None)
         f.write(b"  %10d %10d %-10s %s\n" % (path_size['unpacked'][pathname],
                                             size,
@@ -2872,12 +4038,10 @@ class RepoAnalyze(object):
     with open(os.path.join(reportdir, b"blob-shas-and-paths.txt"), 'bw') as f:
       f.write(("=== %s ===\n" % _("Files by sha and associated pathnames in reverse size")).encode())
       f.write(_("Format: sha, unpacked size, packed size, filename(s) object stored as\n").encode())
-      for sha, size in sorted(stats['packed_size'].items(),
-                              key=lambda x:(x[1],x[0]), reverse=True):
-        if sha not in stats['names']:
-          # Some objects in the repository might not be referenced, or not
-          # referenced by the branches/tags the user cares about; skip them.
-          continue
+      # Some objects in the repository might not be referenced, or not
+      # referenced by the branches/tags the user cares about, so
+      # blobs_by_size only has those in stats['names'].
+      for sha, size in blobs_by_size:
         names_with_sha = stats['names'][sha]
         if len(names_with_sha) == 1:
           names_with_sha = names_with_sha.pop()
@@ -2888,6 +4052,65 @@ class RepoAnalyze(object):
                                           size,
                                           names_with_sha))
 
+  @staticmethod
+  def write_sqlite_report(filename, stats, total_size, tables, blobs_by_size):
+    '''
+    Write the data of the text reports as tables of an SQLite database.
+    tables lists (table name, [(name, packed size)] sorted by reverse packed
+    size, unpacked sizes, deletion dates) for the directories, extensions
+    and paths tables; rows are inserted in the same order as the text
+    reports list them, so ordering by rowid gives that order.
+    '''
+    try:
+      import sqlite3
+    except ImportError: # pragma: no cover
+      raise SystemExit(_("Error: --report-format=sqlite requires python's "
+                         "sqlite3 module"))
+    db = sqlite3.connect(filename)
+    # Nothing to recover if we are interrupted; skip journaling and syncing
+    db.execute('PRAGMA journal_mode = OFF')
+    db.execute('PRAGMA synchronous = OFF')
+
+    db.execute('CREATE TABLE summary (name TEXT PRIMARY KEY, value INTEGER)')
+    db.executemany('INSERT INTO summary VALUES (?, ?)',
+                   [('num_commits', stats['num_commits']),
+                    ('total_unpacked_size', total_size['unpacked']),
+                    ('total_packed_size', total_size['packed'])])
+
+    # Names are paths and so may not be valid UTF-8; store them as BLOBs.
+    # Dates deleted are NULL for things still present.
+    for (table, by_size, unpacked_size, deleted) in tables:
+      db.execute('CREATE TABLE %s (name BLOB, unpacked_size INTEGER,'
+                 ' packed_size INTEGER, deleted TEXT)' % table.decode())
+      dates = {name: when.decode() for (name, when) in deleted.items()
+               if when}
+      db.executemany('INSERT INTO %s VALUES (?, ?, ?, ?)' % table.decode(),
+                     ((name, unpacked_size[name], size, dates.get(name))
+                      for (name, size) in by_size))
+
+    db.execute('CREATE TABLE blobs (sha TEXT, unpacked_size INTEGER,'
+               ' packed_size INTEGER)')
+    unpacked_size = stats['unpacked_size']
+    db.executemany('INSERT INTO blobs VALUES (?, ?, ?)',
+                   ((sha.decode(), unpacked_size[sha], size)
+                    for (sha, size) in blobs_by_size))
+    db.execute('CREATE TABLE blob_paths (sha TEXT, path BLOB)')
+    db.executemany('INSERT INTO blob_paths VALUES (?, ?)',
+                   ((sha.decode(), name) for (sha, size) in blobs_by_size
+                    for name in sorted(stats['names'][sha])))
+
+    # Each group of names for the same file gets its own id, with position
+    # giving the order of the names within the group
+    db.execute('CREATE TABLE renames (id INTEGER, position INTEGER,'
+               ' path BLOB)')
+    groups = sorted(set(stats['equivalence'].values()))
+    db.executemany('INSERT INTO renames VALUES (?, ?, ?)',
+                   ((group_id, position, name)
+                    for (group_id, group) in enumerate(groups)
+                    for (position, name) in enumerate(group)))
+    db.commit()
+    db.close()
+
   @staticmethod
   def run(args):
     if args.report_dir:
@@ -2901,8 +4124,17 @@ class RepoAnalyze(object):
         os.mkdir(results_tmp_dir)
       reportdir = os.path.join(results_tmp_dir, b"analysis")
 
+    snapshot = {}
+    snapshot_file = os.path.join(reportdir, b'.snapshot')
     if os.path.isdir(reportdir):
-      if args.force:
+      if args.incremental and os.path.isfile(snapshot_file):
+        # The directory has results of a previous run we can update
+        snapshot = RepoAnalyze.load_snapshot(args, snapshot_file)
+        if not snapshot:
+          sys.stdout.write(_("Previous analysis cannot be reused; analyzing "
+                             "all history.\n"))
+        shutil.rmtree(reportdir)
+      elif args.force:
         sys.stdout.write(_("Warning: Removing recursively: \"%s\"\n") % decode(reportdir))
         shutil.rmtree(reportdir)
       else:
@@ -2912,14 +4144,350 @@ class RepoAnalyze(object):
     os.mkdir(reportdir)
 
     # Gather the data we need
-    stats = RepoAnalyze.gather_data(args)
+    stats = RepoAnalyze.gather_data(args, snapshot)
+    if args.incremental:
+      RepoAnalyze.save_snapshot(snapshot_file, snapshot)
 
     # Write the reports
     sys.stdout.write(_("Writing reports to %s...") % decode(reportdir))
     sys.stdout.flush()
-    RepoAnalyze.write_report(reportdir, stats)
+    RepoAnalyze.write_report(reportdir, stats, args.report_format,
+                             args.report_top)
     sys.stdout.write(_("done.\n"))
 
+class LiteralReplacer(object):
+  '''
+  Replaces many literal bytestrings at once, with the same result as calling
+  bytes.replace() for each (literal, replacement) pair in turn.
+
+  Data is first checked against a cheap filter: split the data into N-byte
+  chunks; any occurrence of a literal at least 2*N-1 bytes long must
+  contain a whole chunk, and that chunk must be one of the N-byte pieces
+  starting within the first N bytes of the literal.  If none of the chunks
+  are such pieces, the data is returned untouched.  Otherwise, the literals
+  are found with a single regex built as a trie of all the literals, and
+  only those present are replaced; the data is only searched again after a
+  replacement that could create new occurrences of later literals.
+  '''
+  def __init__(self, literals):
+    self._literals = literals
+
+    # Indices into literals for each distinct literal
+    self._indices = {}
+    for index, (literal, replacement) in enumerate(literals):
+      self._indices.setdefault(literal, []).append(index)
+
+    # Indices of all literals matching at a position where the given literal
+    # is the longest one matching; i.e. the literal and its prefixes
+    self._matching = {}
+    for literal in self._indices:
+      self._matching[literal] = [i for n in range(1, len(literal)+1)
+                                   for i in self._indices.get(literal[0:n], ())]
+
+    # Maps replacements to the index of the last literal they could create
+    # new occurrences of; filled in lazily by _last_creatable()
+    self._last_created = {}
+
+    # Set up the chunk filter, using the biggest chunk size the shortest
+    # literal allows
+    self._chunk_type = None
+    shortest = min(len(x) for x in self._indices)
+    for typecode in 'QIH':
+      size = array.array(typecode).itemsize
+      if shortest >= 2*size - 1:
+        self._chunk_type = typecode
+        self._chunks = set()
+        for literal in self._indices:
+          for offset in range(size):
+            chunk = array.array(typecode, literal[offset:offset+size])
+            self._chunks.add(chunk[0])
+        break
+
+    # Build a trie of the literals and compile it into a regex which, at any
+    # given position, matches the longest literal found there
+    trie = {}
+    for literal in self._indices:
+      node = trie
+      for byte in literal:
+        node = node.setdefault(byte, {})
+      node[None] = True
+    try:
+      self._regex = re.compile(self._trie_to_regex(trie))
+    except (RecursionError, OverflowError, re.error): # pragma: no cover
+      by_length = sorted(self._indices, key=len, reverse=True)
+      self._regex = re.compile(b'|'.join(re.escape(x) for x in by_length))
+
+  @staticmethod
+  def _trie_to_regex(node):
+    alternatives = []
+    for byte in sorted(x for x in node if x is not None):
+      child = node[byte]
+      chain = [byte]
+      # Don't bother creating a group for each character of a literal
+      while len(child) == 1 and None not in child:
+        (byte, child), = child.items()
+        chain.append(byte)
+      alternatives.append(re.escape(bytes(chain)) +
+                          LiteralReplacer._trie_to_regex(child))
+    if not alternatives:
+      return b''
+    if len(alternatives) == 1 and None not in node:
+      return alternatives[0]
+    # Making the group optional after the end of a literal is greedy, so the
+    # longest literal found at any position is the one matched
+    return b'(?:' + b'|'.join(alternatives) + (b')?' if None in node else b')')
+
+  @staticmethod
+  def _may_create(replacement, literal):
+    '''
+    Whether inserting replacement into some text could create a new
+    occurrence of literal; for that, the two would need to overlap.
+    '''
+    if not replacement:
+      return True  # Removing text can join its neighbors into anything
+    if literal in replacement or replacement in literal:
+      return True
+    for n in range(1, min(len(literal), len(replacement))):
+      if replacement.endswith(literal[0:n]) or \
+         replacement.startswith(literal[-n:]):
+        return True
+    return False
+
+  def _last_creatable(self, replacement):
+    if replacement not in self._last_created:
+      last = -1
+      for index in reversed(range(len(self._literals))):
+        if self._may_create(replacement, self._literals[index][0]):
+          last = index
+          break
+      self._last_created[replacement] = last
+    return self._last_created[replacement]
+
+  def _find_present(self, data, first_index = 0):
+    present = set()
+    search = self._regex.search
+    match = search(data)
+    while match:
+      present.update(self._matching[match.group()])
+      match = search(data, match.start()+1)
+    return sorted(x for x in present if x >= first_index)
+
+  def replace(self, data):
+    if self._chunk_type:
+      size = array.array(self._chunk_type).itemsize
+      chunks = array.array(self._chunk_type, data[0:len(data)//size*size])
+      if self._chunks.isdisjoint(chunks):
+        return data
+    present = self._find_present(data)
+    while present:
+      index = present.pop(0)
+      literal, replacement = self._literals[index]
+      data = data.replace(literal, replacement)
+      if self._last_creatable(replacement) > index:
+        present = self._find_present(data, index+1)
+    return data
+
+def apply_replace_text(replace_text, contents):
+  '''
+  Apply the literal and regex replacements in replace_text (as returned by
+  FilteringOptions.get_replace_text) to contents and return the result.
+  If nothing matches, contents itself is returned.
+  '''
+  if replace_text.get('literal_replacer'):
+    contents = replace_text['literal_replacer'].replace(contents)
+  else:
+    for literal, replacement in replace_text['literals']:
+      contents = contents.replace(literal, replacement)
+  for regex,   replacement in replace_text['regexes']:
+    contents = regex.sub(replacement, contents)
+  return contents
+
+# The replacement rules used by a ParallelBlobRewriter worker process
+_worker_replace_text = None
+
+def _init_blob_rewrite_worker(replace_text):
+  global _worker_replace_text
+  _worker_replace_text = replace_text
+
+def _rewrite_blob_batch(batch):
+  '''
+  Apply the worker's replacement rules to each of the blob contents in
+  batch.  Contents which did not change are returned as None, so that they
+  need not be sent back to the parent process.
+  '''
+  results = []
+  for contents in batch:
+    new_contents = apply_replace_text(_worker_replace_text, contents)
+    results.append(None if new_contents == contents else new_contents)
+  return results
+
+class ParallelBlobRewriter(object):
+  '''
+  Applies --replace-text rules to blobs using a pool of worker processes.
+  submit() queues up a blob to be rewritten in the background, and
+  rewrite() returns the new contents for a blob, waiting for the workers if
+  needed.  Blobs are handed to the workers in batches to amortize the cost
+  of talking to them; asking for a blob from a batch that has not been sent
+  yet sends it right away.
+  '''
+  max_batch_blobs = 256
+  max_batch_bytes = 4*1024*1024
+
+  def __init__(self, jobs, replace_text):
+    import multiprocessing
+    self._replace_text = replace_text
+    self._pool = multiprocessing.Pool(jobs,
+                                      initializer = _init_blob_rewrite_worker,
+                                      initargs = (replace_text,))
+
+    # Maps blob ids to (batch, index of the blob within the batch).  Each
+    # batch is a list of [list of blob contents, AsyncResult or None]
+    self._pending = {}
+    self._batch = None
+    self._batch_bytes = 0
+
+  def _send_batch(self):
+    self._batch[1] = self._pool.apply_async(_rewrite_blob_batch,
+                                            (self._batch[0],))
+    self._batch = None
+
+  def submit(self, blob):
+    if not self._batch:
+      self._batch = [[], None]
+      self._batch_bytes = 0
+    self._pending[blob.id] = (self._batch, len(self._batch[0]))
+    self._batch[0].append(blob.data)
+    self._batch_bytes += len(blob.data)
+    if len(self._batch[0]) >= self.max_batch_blobs or \
+       self._batch_bytes >= self.max_batch_bytes:
+      self._send_batch()
+
+  def is_pending(self, blob):
+    return blob.id in self._pending
+
+  def rewrite(self, blob):
+    if blob.id not in self._pending:
+      return apply_replace_text(self._replace_text, blob.data)
+    batch, index = self._pending.pop(blob.id)
+    if batch is self._batch:
+      self._send_batch()
+    new_contents = batch[1].get()[index]
+    return blob.data if new_contents is None else new_contents
+
+  def close(self):
+    self._pool.close()
+    self._pool.join()
+
+class ReplaceTextCache(object):
+  '''
+  An on-disk cache of the results of applying --replace-text rules to
+  blobs, so that later runs with the same rules need not rewrite blobs
+  they have seen before.  Entries are keyed by the original blob id and a
+  hash of the rules, and record either that the blob was left unchanged or
+  its new contents.  When the cache grows beyond max_size bytes, entries
+  which have gone unused for the most runs are evicted first.
+  '''
+  # Rough per-entry overhead, in bytes, counted against max_size
+  entry_overhead = 128
+  max_buffered_entries = 1000
+  max_buffered_bytes = 16*1024*1024
+
+  def __init__(self, filename, replace_text, max_size):
+    try:
+      import sqlite3
+    except ImportError: # pragma: no cover
+      raise SystemExit(_("Error: --replace-text-cache requires python's "
+                         "sqlite3 module"))
+    self._max_size = max_size
+    self._rules = ReplaceTextCache.rules_hash(replace_text)
+    self._db = sqlite3.connect(filename)
+    # Losing the cache in a crash only costs us some time; don't fsync
+    self._db.execute('PRAGMA synchronous = OFF')
+    self._db.execute('CREATE TABLE IF NOT EXISTS blobs'
+                     ' (rules BLOB, blob_id BLOB, contents BLOB,'
+                     '  size INTEGER, last_used INTEGER,'
+                     '  PRIMARY KEY (rules, blob_id))')
+    self._db.execute('CREATE INDEX IF NOT EXISTS blobs_by_last_used'
+                     ' ON blobs (last_used)')
+    self._run = self._db.execute(
+      'SELECT COALESCE(MAX(last_used), 0) + 1 FROM blobs').fetchone()[0]
+
+    # New entries and the ids of used entries, not yet written out
+    self._new_entries = []
+    self._new_bytes = 0
+    self._used = []
+    self.hits = 0
+    self.misses = 0
+
+  @staticmethod
+  def rules_hash(replace_text):
+    h = hashlib.sha1(b'replace-text-cache-v1\0')
+    for literal, replacement in replace_text['literals']:
+      h.update(b'L %d %d\0%s%s' % (len(literal), len(replacement),
+                                    literal, replacement))
+    for regex, replacement in replace_text['regexes']:
+      h.update(b'R %d %d %d\0%s%s' % (regex.flags, len(regex.pattern),
+                                       len(replacement), regex.pattern,
+                                       replacement))
+    return h.digest()
+
+  def get(self, blob):
+    '''
+    Return the cached new contents of blob, or None if it is not cached.
+    '''
+    if not blob.original_id:
+      return None
+    row = self._db.execute('SELECT contents FROM blobs'
+                           ' WHERE rules = ? AND blob_id = ?',
+                           (self._rules, blob.original_id)).fetchone()
+    if row is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self._used.append(blob.original_id)
+    return blob.data if row[0] is None else row[0]
+
+  def put(self, blob, new_contents):
+    if not blob.original_id:
+      return
+    if new_contents == blob.data:
+      new_contents = None
+    size = self.entry_overhead + len(new_contents or b'')
+    self._new_entries.append((self._rules, blob.original_id, new_contents,
+                              size, self._run))
+    self._new_bytes += size
+    if len(self._new_entries) >= self.max_buffered_entries or \
+       self._new_bytes >= self.max_buffered_bytes:
+      self._flush()
+
+  def _flush(self):
+    self._db.executemany('INSERT OR REPLACE INTO blobs VALUES (?, ?, ?, ?, ?)',
+                         self._new_entries)
+    self._db.executemany('UPDATE blobs SET last_used = ?'
+                         ' WHERE rules = ? AND blob_id = ?',
+                         [(self._run, self._rules, x) for x in self._used])
+    self._db.commit()
+    self._new_entries = []
+    self._new_bytes = 0
+    self._used = []
+
+  def close(self):
+    self._flush()
+    total = self._db.execute('SELECT TOTAL(size) FROM blobs').fetchone()[0]
+    if total > self._max_size:
+      excess = total - self._max_size
+      evict = []
+      for rules, blob_id, size in self._db.execute(
+          'SELECT rules, blob_id, size FROM blobs ORDER BY last_used'):
+        if excess <= 0:
+          break
+        evict.append((rules, blob_id))
+        excess -= size
+      self._db.executemany('DELETE FROM blobs WHERE rules = ? AND blob_id = ?',
+                           evict)
+      self._db.commit()
+    self._db.close()
+
 class FileInfoValueHelper:
   def __init__(self, replace_text, insert_blob_func, source_working_dir):
     self.data = {}
@@ -2967,12 +4535,7 @@ class FileInfoValueHelper:
     return b"\0" in contents[0:8192]
 
   def apply_replace_text(self, contents):
-    new_contents = contents
-    for literal, replacement in self._replace_text['literals']:
-      new_contents = new_contents.replace(literal, replacement)
-    for regex,   replacement in self._replace_text['regexes']:
-      new_contents = regex.sub(replacement, new_contents)
-    return new_contents
+    return apply_replace_text(self._replace_text, contents)
 
 class LFSObjectTracker:
   class LFSObjs:
@@ -3095,6 +4658,10 @@ class DualFileWriter:
     self.file1.write(*args)
     self.file2.write(*args)
 
+  def writelines(self, lines):
+    self.file1.writelines(lines)
+    self.file2.writelines(lines)
+
   def flush(self):
     self.file1.flush()
     self.file2.flush()
@@ -3155,13 +4722,15 @@ class RepoFilter(object):
     self._import_pipes = None
     self._managed_output = True
 
-    # A tuple of (depth, list-of-ancestors).  Commits and ancestors are
+    # The ancestry of commits we write out.  Commits and ancestors are
     # identified by their id (their 'mark' in fast-export or fast-import
     # speak).  The depth of a commit is one more than the max depth of any
-    # of its ancestors.
-    self._graph = AncestryGraph()
+    # of its ancestors.  Ancestry is only queried when pruning degenerate
+    # merges, so only pay for the reachability index if we might.
+    index = (args.prune_degenerate != 'never')
+    self._graph = AncestryGraph(reachability_index = index)
     # Another one, for ancestry of commits in the original repo
-    self._orig_graph = AncestryGraph()
+    self._orig_graph = AncestryGraph(reachability_index = index)
 
     # Names of files that were tweaked in any commit; such paths could lead
     # to subsequent commits being empty
@@ -3185,12 +4754,21 @@ class RepoFilter(object):
     # id (i.e. commit.id)
     self._pending_renames = collections.OrderedDict()
 
-    # A dict of commit_hash[0:7] -> set(commit_hashes with that prefix).
+    # Whether some of the get-mark requests for _pending_renames may still
+    # be sitting in our output buffer rather than sent to fast-import
+    self._pending_renames_unflushed = False
+
+    # Statistics about reading _pending_renames, reported with --debug: the
+    # most renames pending at once, and the time spent waiting on them.
+    self._max_pending_renames = 0
+    self._pending_renames_wait = 0.0
+
+    # An index of the original commit hashes, by prefix.
     #
     # It's common for commit messages to refer to commits by abbreviated
     # commit hashes, as short as 7 characters.  To facilitate translating
-    # such short hashes, we have a mapping of prefixes to full old hashes.
-    self._commit_short_old_hashes = collections.defaultdict(set)
+    # such short hashes, we can look up full old hashes from prefixes.
+    self._commit_short_old_hashes = HashPrefixIndex()
 
     # A set of commit hash references appearing in commit messages which
     # mapped to a valid commit that was removed entirely in the filtering
@@ -3207,15 +4785,36 @@ class RepoFilter(object):
     self._progress_writer = ProgressWriter()
     self._num_commits = 0
 
-    # Size of blobs in the repo
-    self._unpacked_size = {}
+    # Blobs bigger than --strip-blobs-bigger-than, if we are not going to
+    # see blob contents
+    self._large_blobs = set()
+
+    # Worker processes for rewriting blobs with --replace-text, if --jobs > 1
+    self._blob_rewriter = None
+
+    # Cache of --replace-text results from previous runs, if requested, and
+    # the cached results looked up for blobs queued for the rewriter
+    self._replace_text_cache = None
+    self._cached_blob_contents = {}
 
     # Other vars
     self._sanity_checks_handled = False
     self._finalize_handled = False
     self._orig_refs = None
     self._config_settings = {}
-    self._newnames = {}
+    self._path_filter = None
+    self._newnames = None
+    self._prefix_change = None
+
+    # Pathspecs we limited fast-export's output to, if any; see
+    # _setup_fast_export_pathspec().  If set, we use _cat_file_process to
+    # ask about things fast-export didn't show us.
+    self._fast_export_pathspec = None
+    self._cat_file_process = None
+
+    # Length of object names in the target repository, once we need it;
+    # see _hash_hex_length()
+    self._hash_hexsz = None
     self._stash = None
 
     # Cache a few message translations for performance reasons
@@ -3571,6 +5170,14 @@ class RepoFilter(object):
     #   limit > 0 and len(self._pending_renames) < limit
     if limit and len(self._pending_renames) < 2 * limit:
       return
+    self._max_pending_renames = max(self._max_pending_renames,
+                                    len(self._pending_renames))
+    if not self._pending_renames:
+      return
+    if self._pending_renames_unflushed:
+      self._output.flush()
+      self._pending_renames_unflushed = False
+    start = time.perf_counter()
     fi_input, fi_output = self._import_pipes
     while self._pending_renames:
       orig_hash, new_fast_export_id = self._pending_renames.popitem(last=False)
@@ -3578,9 +5185,10 @@ class RepoFilter(object):
       self._commit_renames[orig_hash] = new_hash
       self._graph.record_hash(new_fast_export_id, new_hash)
       if old_hash == orig_hash:
-        return
+        break
       if limit and len(self._pending_renames) < limit:
-        return
+        break
+    self._pending_renames_wait += time.perf_counter() - start
 
   def _translate_commit_hash(self, matchobj_or_oldhash):
     old_hash = matchobj_or_oldhash
@@ -3589,12 +5197,7 @@ class RepoFilter(object):
     orig_len = len(old_hash)
     new_hash = self._get_rename(old_hash)
     if new_hash is None:
-      if old_hash[0:7] not in self._commit_short_old_hashes:
-        self._commits_referenced_but_removed.add(old_hash)
-        return old_hash
-      possibilities = self._commit_short_old_hashes[old_hash[0:7]]
-      matches = [x for x in possibilities
-                 if x[0:orig_len] == old_hash]
+      matches = self._commit_short_old_hashes.lookup(old_hash)
       if len(matches) != 1:
         self._commits_referenced_but_removed.add(old_hash)
         return old_hash
@@ -3713,9 +5316,16 @@ class RepoFilter(object):
         had_parents_pruned = (len(parents) < len(orig_parents) or
                               (len(orig_parents) == 1 and
                                orig_parents[0] in _SKIPPED_COMMITS))
-        # If the commit remains empty and had parents which were pruned,
-        # then prune this commit; otherwise, retain it
-        return (not commit.file_changes and had_parents_pruned)
+        # If fast-export was limited to a pathspec, it would not have shown
+        # us changes outside of it, so the commit may not have really started
+        # empty.  No need to check if it is empty and had parents pruned,
+        # since it's prunable either way then.
+        if not self._fast_export_pathspec or \
+           (had_parents_pruned and not commit.file_changes) or \
+           self._started_empty(commit):
+          # If the commit remains empty and had parents which were pruned,
+          # then prune this commit; otherwise, retain it
+          return (not commit.file_changes and had_parents_pruned)
 
       # We can only get here if the commit didn't start empty, so if it's
       # empty now, it obviously became empty
@@ -3761,44 +5371,115 @@ class RepoFilter(object):
     #     our first parent has a tree that matches the merge base, then if
     #     the new first parent has a tree matching the versions of files in
     #     file_changes, then this new commit is empty and thus prunable.
-    fi_input, fi_output = self._import_pipes
     self._flush_renames()  # Avoid fi_output having other stuff present
-    # Optimization note: we could have two loops over file_changes, the
-    # first doing all the self._output.write() calls, and the second doing
-    # the rest.  But I'm worried about fast-import blocking on fi_output
-    # buffers filling up so I instead read from it as I go.
+    # Rather than waiting for the answer to each query before sending the
+    # next, send queries in batches and then read all the answers.  We
+    # cannot send everything at once, because fast-import would block on
+    # fi_output buffers filling up while we are blocked writing to it; so
+    # we bound the size of the answers we can have outstanding.  Also, the
+    # first file often differs from the parent's version, so start with a
+    # batch of one and double the batch length each time.
+    parent = new_1st_parent or commit.parents[0] # exists due to above checks
+    if isinstance(parent, int):
+      parent = b':%d' % parent
+    hexsz = self._hash_hex_length()
+    batch = []
+    batch_size = 0
+    batch_length = 1
     for change in commit.file_changes:
-      parent = new_1st_parent or commit.parents[0] # exists due to above checks
       quoted_filename = PathQuoting.enquote(change.filename)
-      if isinstance(parent, int):
-        self._output.write(b"ls :%d %s\n" % (parent, quoted_filename))
-      else:
-        self._output.write(b"ls %s %s\n" % (parent, quoted_filename))
-      self._output.flush()
+      query = b"ls %s %s\n" % (parent, quoted_filename)
+      # Answer is "<mode> blob <hash>\t<filename>\n", or "missing <filename>"
+      answer_size = hexsz + 20 + len(quoted_filename)
+      if change.type != b'D' and isinstance(change.blob_id, int):
+        query += b"get-mark :%d\n" % change.blob_id
+        answer_size += hexsz + 1
+      if len(batch) == batch_length or \
+         (batch and batch_size + answer_size > self._max_pending_answers_size):
+        if not self._matches_parent_versions(batch):
+          return False
+        batch = []
+        batch_size = 0
+        batch_length *= 2
+      self._output.write(query)
+      batch.append((change, quoted_filename))
+      batch_size += answer_size
+
+    return self._matches_parent_versions(batch)
+
+  def _hash_hex_length(self):
+    '''
+    Returns the number of hex characters in object names of the target
+    repository, i.e. 64 for SHA-256 repositories and 40 otherwise.
+    '''
+    if not self._hash_hexsz:
+      location = ['-C', self._args.target] if self._args.target else []
+      object_format = subproc.check_output(['git'] + location +
+                                           ['rev-parse',
+                                            '--show-object-format'])
+      self._hash_hexsz = 64 if object_format.strip() == b'sha256' else 40
+    return self._hash_hexsz
+
+  # Maximum number of bytes of answers from fast-import we allow to be
+  # outstanding in _prunable(); kept below the smallest pipe buffer size of
+  # the platforms we support.
+  _max_pending_answers_size = 4096
+
+  def _matches_parent_versions(self, batch):
+    '''
+    Read fast-import's answers to the queries _prunable() sent for the
+    (change, quoted_filename) pairs in batch, and return whether every
+    change matches the version of the file in the parent.
+    '''
+    self._output.flush()
+    fi_input, fi_output = self._import_pipes
+    # Make sure to read all the answers, even after finding a mismatch
+    matches = True
+    for change, quoted_filename in batch:
       parent_version = fi_output.readline().split()
       if change.type == b'D':
         if parent_version != [b'missing', quoted_filename]:
-          return False
+          matches = False
       else:
         blob_sha = change.blob_id
         if isinstance(change.blob_id, int):
-          self._output.write(b"get-mark :%d\n" % change.blob_id)
-          self._output.flush()
           blob_sha = fi_output.readline().rstrip()
         if parent_version != [change.mode, b'blob', blob_sha, quoted_filename]:
-          return False
+          matches = False
+    return matches
 
-    return True
+  def _started_empty(self, commit):
+    '''
+    Returns whether commit had the same tree as its first parent, or an
+    empty tree if it has no parents, in the original repository.
+    '''
+    if not self._cat_file_process:
+      cmd = ['git', 'cat-file', '--batch-check']
+      self._cat_file_process = subproc.Popen(cmd,
+                                             stdin = subprocess.PIPE,
+                                             stdout = subprocess.PIPE,
+                                             cwd = self._repo_working_dir)
+    orig_id = commit.original_id
+    self._cat_file_process.stdin.write(b'%s^{tree}\n%s^^{tree}\n'
+                                       % (orig_id, orig_id))
+    self._cat_file_process.stdin.flush()
+    tree = self._cat_file_process.stdout.readline().split()
+    parent_tree = self._cat_file_process.stdout.readline().split()
+    if parent_tree[-1] == b'missing':
+      return tree[2] == b'0'
+    return tree[0] == parent_tree[0]
 
   def _record_remapping(self, commit, orig_parents):
     new_id = None
     # Record the mapping of old commit hash to new one
     if commit.original_id and self._import_pipes:
       fi_input, fi_output = self._import_pipes
+      # We do not need the answer until _flush_renames(), so avoid flushing
+      # our output here; that would cost a write to the pipe per commit.
       self._output.write(b"get-mark :%d\n" % commit.id)
-      self._output.flush()
+      self._pending_renames_unflushed = True
       orig_id = commit.original_id
-      self._commit_short_old_hashes[orig_id[0:7]].add(orig_id)
+      self._commit_short_old_hashes.add(orig_id)
       # Note that we have queued up an id for later reading; flush a
       # few of the older ones if we have too many queued up
       self._pending_renames[orig_id] = commit.id
@@ -3814,22 +5495,53 @@ class RepoFilter(object):
             'original_ancestry_graph': self._orig_graph,
             **extra_items}
 
-  def _tweak_blob(self, blob):
-    if self._args.max_blob_size and len(blob.data) > self._args.max_blob_size:
-      blob.skip()
+  def _is_stripped_blob(self, blob):
+    return ((self._args.max_blob_size and
+             len(blob.data) > self._args.max_blob_size) or
+            blob.original_id in self._args.strip_blobs_with_ids)
+
+  def _queue_blob(self, blob):
+    # Start rewriting blob in the background; _tweak_blob picks up the result
+    if b"\0" in blob.data[0:8192]:
+      return
+    if not self._blob_callback and self._is_stripped_blob(blob):
+      return
+    if self._replace_text_cache:
+      new_contents = self._replace_text_cache.get(blob)
+      if new_contents is not None:
+        self._cached_blob_contents[blob.id] = new_contents
+        return
+    self._blob_rewriter.submit(blob)
+
+  def _replace_text_in_blob(self, blob):
+    cache = self._replace_text_cache
+    if self._blob_rewriter and self._blob_rewriter.is_pending(blob):
+      new_contents = self._blob_rewriter.rewrite(blob)
+    else:
+      if blob.id in self._cached_blob_contents:
+        return self._cached_blob_contents.pop(blob.id)
+      new_contents = cache.get(blob) if cache else None
+      if new_contents is not None:
+        return new_contents
+      new_contents = apply_replace_text(self._args.replace_text, blob.data)
+    if cache:
+      cache.put(blob, new_contents)
+    return new_contents
 
-    if blob.original_id in self._args.strip_blobs_with_ids:
+  def _tweak_blob(self, blob):
+    stripped = self._is_stripped_blob(blob)
+    if stripped:
       blob.skip()
 
     if ( self._args.replace_text
         and not self._file_info_callback
+        # not if the blob is stripped anyway, unless the blob callback could
+        # look at its contents
+        and not (stripped and not self._blob_callback)
         # not (if blob contains zero byte in the first 8Kb, that is, if blob is binary data)
         and not b"\0" in blob.data[0:8192]
     ):
-      for literal, replacement in self._args.replace_text['literals']:
-        blob.data = blob.data.replace(literal, replacement)
-      for regex,   replacement in self._args.replace_text['regexes']:
-        blob.data = regex.sub(replacement, blob.data)
+      blob.data = self._replace_text_in_blob(blob)
 
     if self._blob_callback:
       self._blob_callback(blob, self.callback_metadata())
@@ -3837,49 +5549,9 @@ class RepoFilter(object):
     self._insert_into_stream(blob)
 
   def _filter_files(self, commit):
-    def filename_matches(path_expression, pathname):
-      ''' Returns whether path_expression matches pathname or a leading
-          directory thereof, allowing path_expression to not have a trailing
-          slash even if it is meant to match a leading directory. '''
-      if path_expression == b'':
-        return True
-      n = len(path_expression)
-      if (pathname.startswith(path_expression) and
-          (path_expression[n-1:n] == b'/' or
-           len(pathname) == n or
-           pathname[n:n+1] == b'/')):
-        return True
-      return False
-
-    def newname(path_changes, pathname, use_base_name, filtering_is_inclusive):
-      ''' Applies filtering and rename changes from path_changes to pathname,
-          returning any of None (file isn't wanted), original filename (file
-          is wanted with original name), or new filename. '''
-      wanted = False
-      full_pathname = pathname
-      if use_base_name:
-        pathname = os.path.basename(pathname)
-      for (mod_type, match_type, path_exp) in path_changes:
-        if mod_type == 'filter' and not wanted:
-          assert match_type in ('match', 'glob', 'regex')
-          if match_type == 'match' and filename_matches(path_exp, pathname):
-            wanted = True
-          if match_type == 'glob' and fnmatch.fnmatch(pathname, path_exp):
-            wanted = True
-          if match_type == 'regex' and path_exp.search(pathname):
-            wanted = True
-        elif mod_type == 'rename':
-          match, repl = path_exp
-          assert match_type in ('match','regex') # glob was translated to regex
-          if match_type == 'match' and filename_matches(match, full_pathname):
-            full_pathname = full_pathname.replace(match, repl, 1)
-            pathname = full_pathname # rename incompatible with use_base_name
-          if match_type == 'regex':
-            full_pathname = match.sub(repl, full_pathname)
-            pathname = full_pathname # rename incompatible with use_base_name
-      return full_pathname if (wanted == filtering_is_inclusive) else None
-
-    args = self._args
+    prefix_change = self._prefix_change
+    if prefix_change:
+      old_prefix, new_prefix = prefix_change
     new_file_changes = {}  # Assumes no renames or copies, otherwise collisions
     for change in commit.file_changes:
       # NEEDSWORK: _If_ we ever want to pass `--full-tree` to fast-export and
@@ -3890,15 +5562,13 @@ class RepoFilter(object):
       if change.type == b'DELETEALL':
         new_file_changes[b''] = change
         continue
-      if change.filename in self._newnames:
-        change.filename = self._newnames[change.filename]
+      if prefix_change:
+        if change.filename.startswith(old_prefix):
+          change.filename = new_prefix + change.filename[len(old_prefix):]
+        else:
+          change.filename = None
       else:
-        original_filename = change.filename
-        change.filename = newname(args.path_changes, change.filename,
-                                  args.use_base_name, args.inclusive)
-        if self._filename_callback:
-          change.filename = self._filename_callback(change.filename)
-        self._newnames[original_filename] = change.filename
+        change.filename = self._newnames.newname(change.filename)
       if not change.filename:
         continue # Filtering criteria excluded this file; move on to next one
       if change.filename in new_file_changes:
@@ -3932,8 +5602,7 @@ class RepoFilter(object):
                            _("  Commit: {}\n").format(commit.original_id) +
                            _("  Filename: {}").format(change.filename))
       # Strip files that are too large
-      if self._args.max_blob_size and \
-         self._unpacked_size.get(change.blob_id, 0) > self._args.max_blob_size:
+      if change.blob_id in self._large_blobs:
         continue
       if self._args.strip_blobs_with_ids and \
          change.blob_id in self._args.strip_blobs_with_ids:
@@ -3944,10 +5613,8 @@ class RepoFilter(object):
 
   def _tweak_commit(self, commit, aux_info):
     if self._args.replace_message:
-      for literal, replacement in self._args.replace_message['literals']:
-        commit.message = commit.message.replace(literal, replacement)
-      for regex,   replacement in self._args.replace_message['regexes']:
-        commit.message = regex.sub(replacement, commit.message)
+      commit.message = apply_replace_text(self._args.replace_message,
+                                          commit.message)
     if self._message_callback:
       commit.message = self._message_callback(commit.message)
 
@@ -3979,7 +5646,7 @@ class RepoFilter(object):
       commit.branch = self._refname_callback(commit.branch)
 
     # Filter or rename the list of file changes
-    orig_file_changes = set(commit.file_changes)
+    orig_file_changes = list(commit.file_changes)
     self._filter_files(commit)
 
     # Record ancestry graph
@@ -4075,7 +5742,7 @@ class RepoFilter(object):
                                                       commit.original_id)
 
       # Save these and filter them
-      orig_file_changes = set(commit.file_changes)
+      orig_file_changes = list(commit.file_changes)
       self._filter_files(commit)
 
     # Process the --file-info-callback
@@ -4116,13 +5783,16 @@ class RepoFilter(object):
     # Find out which files were modified by the callbacks.  Such paths could
     # lead to subsequent commits being empty (e.g. if removing a line containing
     # a password from every version of a file that had the password, and some
-    # later commit did nothing more than remove that line)
-    final_file_changes = set(commit.file_changes)
+    # later commit did nothing more than remove that line).  FileChanges
+    # compare by identity, so comparing the lists before building any sets
+    # cheaply catches the common case of there being no differences.
     if self._args.replace_text or self._blob_callback:
-      differences = orig_file_changes.union(final_file_changes)
-    else:
-      differences = orig_file_changes.symmetric_difference(final_file_changes)
-    self._files_tweaked.update(x.filename for x in differences)
+      self._files_tweaked.update(x.filename for x in orig_file_changes)
+      self._files_tweaked.update(x.filename for x in commit.file_changes)
+    elif commit.file_changes != orig_file_changes:
+      differences = \
+        set(orig_file_changes).symmetric_difference(commit.file_changes)
+      self._files_tweaked.update(x.filename for x in differences)
 
     # Now print the resulting commit, or if prunable skip it
     if not commit.dumped:
@@ -4161,10 +5831,8 @@ class RepoFilter(object):
   def _tweak_tag(self, tag):
     # Tweak the tag message according to callbacks
     if self._args.replace_message:
-      for literal, replacement in self._args.replace_message['literals']:
-        tag.message = tag.message.replace(literal, replacement)
-      for regex,   replacement in self._args.replace_message['regexes']:
-        tag.message = regex.sub(replacement, tag.message)
+      tag.message = apply_replace_text(self._args.replace_message,
+                                       tag.message)
     if self._message_callback:
       tag.message = self._message_callback(tag.message)
 
@@ -4317,6 +5985,64 @@ class RepoFilter(object):
           last = new_hash
       print(_("Rewrote the stash."))
 
+  def _setup_blob_rewriter(self):
+    if self._blob_rewriter or self._args.jobs <= 1:
+      return
+    if not self._args.replace_text or self._file_info_callback:
+      return
+    self._blob_rewriter = ParallelBlobRewriter(self._args.jobs,
+                                               self._args.replace_text)
+
+  def _setup_replace_text_cache(self):
+    if not self._args.replace_text_cache or self._file_info_callback:
+      return
+    filename = os.path.join(self.results_tmp_dir(),
+                            b'replace-text-cache.sqlite')
+    self._replace_text_cache = ReplaceTextCache(filename,
+                                                self._args.replace_text,
+                                                self._args.replace_text_cache)
+
+  def _setup_path_filter(self):
+    # sanity_check_args() normally compiled args.path_changes for us, but
+    # callers could have changed args since then.
+    if self._newnames:
+      return
+    args = self._args
+    path_filter = getattr(args, 'path_filter', None)
+    if not path_filter or not path_filter.is_current(args.path_changes,
+                                                     args.use_base_name,
+                                                     args.inclusive):
+      path_filter = PathFilter(args.path_changes, args.use_base_name,
+                               args.inclusive)
+    self._path_filter = path_filter
+    self._newnames = FilenameCache(path_filter, self._filename_callback,
+                                   getattr(args, 'max_cached_paths', 0))
+    self._prefix_change = None
+    if not self._filename_callback:
+      self._prefix_change = path_filter.prefix_change
+
+  def _setup_fast_export_pathspec(self):
+    '''
+    If fast-export can skip files that our path filtering would discard
+    anyway, without changing our results, record pathspecs for it to do so
+    in self._fast_export_pathspec and return them.
+    '''
+    args = self._args
+    self._setup_path_filter()
+    pathspecs = self._path_filter.pathspecs()
+    if not pathspecs:
+      return None
+    # Callbacks may want to see everything, --dry-run and --debug should
+    # show the full original stream, and sensitive data removal and
+    # --state-branch need to know about all objects
+    if self._blob_callback or self._file_info_callback or \
+       self._commit_callback or self._filename_callback or \
+       args.dry_run or args.debug or \
+       args.sensitive_data_removal or args.state_branch:
+      return None
+    self._fast_export_pathspec = pathspecs
+    return self._fast_export_pathspec
+
   def _setup_input(self, use_done_feature):
     if self._args.stdin:
       self._input = sys.stdin.detach()
@@ -4332,7 +6058,11 @@ class RepoFilter(object):
       if skip_blobs:
         extra_flags.append('--no-data')
         if self._args.max_blob_size:
-          self._unpacked_size, packed_size = GitUtils.get_blob_sizes()
+          max_size = self._args.max_blob_size
+          # Don't leave a cache behind when promising not to modify the
+          # repository
+          self._large_blobs = GitUtils.get_large_blobs(
+            max_size, save_cache = not self._args.dry_run)
       if use_done_feature:
         extra_flags.append('--use-done-feature')
       if write_marks:
@@ -4347,11 +6077,17 @@ class RepoFilter(object):
         extra_flags.append('--reencode='+reencode)
       if self._args.date_order:
         extra_flags.append('--date-order')
+      pathspec = []
+      if self._setup_fast_export_pathspec():
+        # Make sure that limiting to paths doesn't also limit the commits
+        # shown or their parents
+        extra_flags.extend(['--full-history', '--sparse'])
+        pathspec = ['--'] + self._fast_export_pathspec
       location = ['-C', self._args.source] if self._args.source else []
       fep_cmd = ['git'] + location + ['fast-export', '--show-original-ids',
                  '--signed-tags=strip', '--tag-of-filtered-object=rewrite',
                  '--fake-missing-tagger', '--reference-excluded-parents'
-                 ] + extra_flags + self._args.refs
+                 ] + extra_flags + self._args.refs + pathspec
       self._fep = subproc.Popen(fep_cmd, bufsize=-1, stdout=subprocess.PIPE)
       self._input = self._fep.stdout
       if self._args.dry_run or self._args.debug:
@@ -4543,9 +6279,9 @@ class RepoFilter(object):
        otherwise:
          the hash of the rewrite of the first unpruned ancestor of oldish_hash
     '''
-    old_id = self._orig_graph._hash_to_id[oldish_hash]
+    old_id = self._orig_graph.map_from_hash(oldish_hash)
     new_id = _IDS.translate(old_id)
-    new_hash = self._graph.git_hash[new_id] if new_id else deleted_hash
+    new_hash = self._graph.map_to_hash(new_id) if new_id else deleted_hash
     return new_hash
 
   def _compute_metadata(self, metadata_dir, orig_refs):
@@ -4615,7 +6351,6 @@ class RepoFilter(object):
     new_refs = {}
     new_refs_initialized = False
     ref_maps = {}
-    self._orig_graph._ensure_reverse_maps_populated()
     for refname, pair in old_ref_map.items():
       old_hash, hash_ref_becomes_if_not_imported_in_this_run = pair
       if refname not in imported_refs:
@@ -4884,6 +6619,9 @@ class RepoFilter(object):
       if not self._args.dry_run and not self._args.partial:
         self._read_stash()
         self._migrate_origin_to_heads()
+      # Start any worker processes before fast-export and fast-import, so
+      # that the workers do not inherit (and hold open) their pipes
+      self._setup_blob_rewriter()
       self._setup_input(use_done_feature = True)
       self._setup_output()
     assert self._sanity_checks_handled
@@ -4891,13 +6629,41 @@ class RepoFilter(object):
     if self._input:
       # Create and run the filter
       self._repo_working_dir = self._args.source or b'.'
+      self._setup_blob_rewriter()
+      self._setup_replace_text_cache()
+      self._setup_path_filter()
+      early_blob_callback = self._queue_blob if self._blob_rewriter else None
       self._parser = FastExportParser(blob_callback   = self._tweak_blob,
                                       commit_callback = self._tweak_commit,
                                       tag_callback    = self._tweak_tag,
                                       reset_callback  = self._tweak_reset,
-                                      done_callback   = self._final_commands)
+                                      done_callback   = self._final_commands,
+                                      early_blob_callback = early_blob_callback)
       self._setup_lfs_orphaning_checks()
       self._parser.run(self._input, self._output)
+      if self._blob_rewriter:
+        self._blob_rewriter.close()
+      if self._cat_file_process:
+        self._cat_file_process.stdin.close()
+        self._cat_file_process.wait()
+      if self._replace_text_cache:
+        self._replace_text_cache.close()
+        if self._args.debug:
+          print("[DEBUG] Replace-text cache: %d hits, %d misses"
+                % (self._replace_text_cache.hits,
+                   self._replace_text_cache.misses))
+      if self._args.debug:
+        print("[DEBUG] Ancestry cache: %d hits, %d misses"
+              % (self._graph.cache_hits + self._orig_graph.cache_hits,
+                 self._graph.cache_misses + self._orig_graph.cache_misses))
+        print("[DEBUG] Commit renames: at most %d pending, %.2f seconds "
+              "waiting on fast-import" % (self._max_pending_renames,
+                                          self._pending_renames_wait))
+        num_dirs, num_entries, size = self._newnames.stats()
+        print("[DEBUG] Filename cache: %d hits, %d misses; %d directories, "
+              "%d entries, about %d KiB"
+              % (self._newnames.hits, self._newnames.misses,
+                 num_dirs, num_entries, size // 1024))
       if not self._finalize_handled:
         self._final_commands()
 
@@ -4912,6 +6678,7 @@ class RepoFilter(object):
 
     # Close the output and ensure fast-import successfully completes
     self._output.close()
+    self._pending_renames_unflushed = False
     if not self._args.dry_run and self._fip.wait():
       raise SystemExit(_("Error: fast-import failed; see above.")) # pragma: no cover
 